@@ -1,20 +1,92 @@
 import spotipy
-from spotipy.oauth2 import SpotifyOAuth
+from spotify_client import (
+    CACHE_DIR, SOURCE_PLAYLIST_IDS, get_client, iter_pages, load_json_cache, save_json_cache, spotify_call
+)
 from datetime import datetime, timedelta
-from os import getenv
 from dotenv import load_dotenv
 import logging
+import json
+import sqlite3
+import math
+import sys
+from hashlib import blake2b
+from contextlib import closing
+from functools import lru_cache
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import time
 
 load_dotenv()
 
-# Spotify API credentials
-SPOTIPY_CLIENT_ID = getenv('CLIENT_ID')
-SPOTIPY_CLIENT_SECRET = getenv('CLIENT_SECRET')
-SPOTIPY_REDIRECT_URI = getenv('REDIRECT_URI')
+# Expected upper bound on library size and acceptable false-positive rate for
+# the library membership filter. A false positive only skips adding a track.
+LIBRARY_CAPACITY = 200_000
+LIBRARY_ERROR_RATE = 1e-4
 
-# Comma-separated playlist IDs to check (in addition to liked songs)
-SOURCE_PLAYLIST_IDS = getenv('SOURCE_PLAYLIST_IDS', '')
+# Maximum number of albums per request to the several-albums endpoint
+ALBUMS_BATCH_SIZE = 20
+
+# How long cached artist albums stay fresh, in seconds
+ARTIST_ALBUMS_TTL = 3600
+
+# Cache file for the followed artists list
+FOLLOWED_ARTISTS_CACHE = 'followed_artists.json'
+
+# Seconds before the followed artists list is refetched even if the probe matches,
+# catching a follow and an unfollow that leave the total and first artist unchanged
+FOLLOWED_ARTISTS_FULL_REFRESH_AGE = 7 * 24 * 3600
+
+# Number of artists to check concurrently
+MAX_ARTIST_WORKERS = 5
+
+# Number of source playlists to fetch concurrently
+MAX_PLAYLIST_WORKERS = 5
+
+# Only request the parts of each playlist item that are actually used
+PLAYLIST_TRACK_FIELDS = 'total,items(track(id))'
+
+# Release groups to check for new releases (skips compilations and appears_on)
+ARTIST_ALBUM_GROUPS = 'album,single'
+
+class BloomFilter:
+    """Compact probabilistic set for track ID membership tests
+
+    Never reports a missing ID for an added one, but may rarely report an
+    ID as present when it was never added.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.num_bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        digest = blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, item):
+        is_new = False
+        for pos in self._positions(item):
+            byte, mask = pos >> 3, 1 << (pos & 7)
+            if not self.bits[byte] & mask:
+                self.bits[byte] |= mask
+                is_new = True
+        if is_new:
+            self.count += 1
+
+    def update(self, items):
+        for item in items:
+            self.add(item)
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+    def __len__(self):
+        """Approximate number of unique items added"""
+        return self.count
 
 def setup_logging():
     """Set up logging to file and console"""
@@ -37,141 +109,261 @@ def setup_logging():
 
     return logging.getLogger(__name__)
 
+def open_album_cache():
+    """Open the album cache database, creating its tables if needed"""
+    CACHE_DIR.mkdir(exist_ok=True)
+    conn = sqlite3.connect(CACHE_DIR / 'albums.sqlite')
+    conn.execute('CREATE TABLE IF NOT EXISTS albums (album_id TEXT PRIMARY KEY, track_ids TEXT)')
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS artist_albums '
+        '(artist_id TEXT PRIMARY KEY, fetched_at REAL, albums TEXT)'
+    )
+    return conn
+
+def get_cached_album_tracks(cache, album_id):
+    """Get cached track IDs for an album, or None if it isn't cached"""
+    row = cache.execute('SELECT track_ids FROM albums WHERE album_id = ?', (album_id,)).fetchone()
+    return [sys.intern(track_id) for track_id in json.loads(row[0])] if row else None
+
+def cache_album_tracks(cache, album_id, track_ids):
+    """Store an album's track IDs in the cache"""
+    with cache:
+        cache.execute(
+            'INSERT OR REPLACE INTO albums (album_id, track_ids) VALUES (?, ?)',
+            (album_id, json.dumps(track_ids))
+        )
+
 def get_spotify_client():
-    """Initialize and return Spotify client with OAuth"""
-    return spotipy.Spotify(auth_manager=SpotifyOAuth(
-        client_id=SPOTIPY_CLIENT_ID,
-        client_secret=SPOTIPY_CLIENT_SECRET,
-        redirect_uri=SPOTIPY_REDIRECT_URI,
-        scope='user-follow-read user-library-read playlist-modify-public playlist-modify-private'
-    ))
+    """Return the shared Spotify client"""
+    return get_client()
 
 def get_followed_artists(sp, logger):
-    """Get all artists the user follows"""
+    """Get all artists the user follows, reusing the cached list if it is unchanged"""
     logger.info("Fetching followed artists...")
+    started_at = time.time()
+
+    # Probe with a single artist and compare against the cached list
+    cached = load_json_cache(FOLLOWED_ARTISTS_CACHE)
+    if cached and started_at - cached.get('fetched_at', 0) < FOLLOWED_ARTISTS_FULL_REFRESH_AGE:
+        probe = spotify_call(sp.current_user_followed_artists, limit=1)['artists']
+        head_id = probe['items'][0]['id'] if probe['items'] else None
+        if probe['total'] == cached['total'] and head_id == cached['head_id']:
+            logger.info(f"Found {len(cached['artists'])} followed artists (cached)")
+            return cached['artists']
+
     artists = []
-    results = sp.current_user_followed_artists(limit=50)
+    results = spotify_call(sp.current_user_followed_artists, limit=50)
+    total = results['artists']['total']
     artists.extend(results['artists']['items'])
 
     while results['artists']['next']:
-        results = sp.next(results['artists'])
+        results = spotify_call(sp.next, results['artists'])
         artists.extend(results['artists']['items'])
 
+    save_json_cache(FOLLOWED_ARTISTS_CACHE, {
+        'fetched_at': started_at,
+        'total': total,
+        'head_id': artists[0]['id'] if artists else None,
+        'artists': [{'id': artist['id'], 'name': artist['name']} for artist in artists]
+    })
+
     logger.info(f"Found {len(artists)} followed artists")
     return artists
 
+def get_artist_albums(sp, artist_id):
+    """Get an artist's albums/singles, cached on disk for a short time to survive re-runs"""
+    with closing(open_album_cache()) as cache:
+        row = cache.execute(
+            'SELECT fetched_at, albums FROM artist_albums WHERE artist_id = ?', (artist_id,)
+        ).fetchone()
+        if row and time.time() - row[0] < ARTIST_ALBUMS_TTL:
+            return json.loads(row[1])
+
+        results = spotify_call(sp.artist_albums, artist_id, include_groups=ARTIST_ALBUM_GROUPS, limit=50)
+        # Only keep the fields used to find and report new releases
+        albums = [
+            {field: album.get(field) for field in ('id', 'name', 'release_date', 'album_group')}
+            for album in results['items']
+        ]
+
+        with cache:
+            cache.execute(
+                'INSERT OR REPLACE INTO artist_albums (artist_id, fetched_at, albums) VALUES (?, ?, ?)',
+                (artist_id, time.time(), json.dumps(albums))
+            )
+        return albums
+
+@lru_cache(maxsize=None)
+def parse_release_date(release_date):
+    """Parse a release date in any of Spotify's precisions (YYYY, YYYY-MM, YYYY-MM-DD)"""
+    if len(release_date) == 4:  # Year only
+        release_date += '-01-01'
+    elif len(release_date) == 7:  # Year-Month
+        release_date += '-01'
+    return datetime.strptime(release_date, '%Y-%m-%d')
+
 def get_artist_new_releases(sp, artist_id, since_date):
     """Get albums/singles released by artist since given date"""
     new_releases = []
-    results = sp.artist_albums(artist_id, album_type='album,single', limit=50)
+    stale_groups = set()
 
-    for album in results['items']:
-        release_date = album['release_date']
-        # Handle different date formats (YYYY, YYYY-MM, YYYY-MM-DD)
-        if len(release_date) == 4:  # Year only
-            release_date += '-01-01'
-        elif len(release_date) == 7:  # Year-Month
-            release_date += '-01'
+    for album in get_artist_albums(sp, artist_id):
+        # Each release group comes back newest first, so once one release in a
+        # group is too old the rest of that group can be skipped without parsing
+        group = album.get('album_group')
+        if group in stale_groups:
+            continue
 
-        release_datetime = datetime.strptime(release_date, '%Y-%m-%d')
+        # Many releases share a date, so each distinct date is only parsed once
+        release_datetime = parse_release_date(album['release_date'])
 
         if release_datetime >= since_date:
             new_releases.append(album)
+        elif group:
+            stale_groups.add(group)
+            if len(stale_groups) == len(ARTIST_ALBUM_GROUPS.split(',')):
+                break
 
     return new_releases
 
-def get_saved_tracks(sp, logger):
-    """Get all track IDs from user's saved library (liked songs)"""
-    logger.info("Fetching liked songs...")
-    saved_track_ids = set()
-    results = sp.current_user_saved_tracks(limit=50)
-
-    for item in results['items']:
-        saved_track_ids.add(item['track']['id'])
-
-    while results['next']:
-        results = sp.next(results)
+def get_all_artist_new_releases(sp, artists, since_date):
+    """Get new releases for every artist concurrently, in the same order as artists"""
+    with ThreadPoolExecutor(max_workers=MAX_ARTIST_WORKERS) as executor:
+        return list(executor.map(
+            lambda artist: get_artist_new_releases(sp, artist['id'], since_date),
+            artists
+        ))
+
+def iter_saved_track_ids(sp):
+    """Yield track IDs from user's saved library (liked songs) page by page"""
+    pages = iter_pages(lambda offset: sp.current_user_saved_tracks(limit=50, offset=offset), 50)
+    for results in pages:
         for item in results['items']:
-            saved_track_ids.add(item['track']['id'])
-
-    logger.info(f"Found {len(saved_track_ids)} liked songs")
-    return saved_track_ids
-
-def get_playlist_tracks(sp, playlist_id, logger):
-    """Get all track IDs from a specific playlist"""
-    logger.info(f"Fetching tracks from playlist ID: {playlist_id}")
-    track_ids = set()
+            yield item['track']['id']
 
+def iter_playlist_track_ids(sp, playlist_id, logger):
+    """Yield track IDs from a specific playlist page by page"""
     try:
-        results = sp.playlist_tracks(playlist_id, limit=100)
-
-        for item in results['items']:
-            if item['track'] and item['track']['id']:
-                track_ids.add(item['track']['id'])
-
-        while results['next']:
-            results = sp.next(results)
+        pages = iter_pages(
+            lambda offset: sp.playlist_tracks(playlist_id, fields=PLAYLIST_TRACK_FIELDS, limit=100, offset=offset),
+            100
+        )
+        for results in pages:
             for item in results['items']:
                 if item['track'] and item['track']['id']:
-                    track_ids.add(item['track']['id'])
-
-        logger.info(f"Found {len(track_ids)} tracks in playlist")
+                    yield item['track']['id']
     except Exception as e:
         logger.error(f"Error fetching playlist {playlist_id}: {e}")
 
+def get_playlist_tracks(sp, playlist_id, logger):
+    """Get all track IDs from a specific playlist"""
+    logger.info(f"Fetching tracks from playlist ID: {playlist_id}")
+    track_ids = set(iter_playlist_track_ids(sp, playlist_id, logger))
+    logger.info(f"Found {len(track_ids)} tracks in playlist")
     return track_ids
 
 def get_all_library_tracks(sp, source_playlist_ids, logger):
     """Get all track IDs from liked songs and source playlists"""
-    all_tracks = set()
+    all_tracks = BloomFilter(LIBRARY_CAPACITY, LIBRARY_ERROR_RATE)
 
-    # Get liked songs
-    liked_tracks = get_saved_tracks(sp, logger)
-    all_tracks.update(liked_tracks)
+    # Stream every source straight into the filter, no intermediate sets
+    logger.info("Fetching liked songs...")
+    all_tracks.update(iter_saved_track_ids(sp))
+    logger.info(f"Found {len(all_tracks)} liked songs")
 
     # Get tracks from source playlists
     if source_playlist_ids:
-        playlist_ids = [pid.strip() for pid in source_playlist_ids.split(',') if pid.strip()]
-        logger.info(f"Checking {len(playlist_ids)} source playlist(s)")
-
-        for playlist_id in playlist_ids:
-            playlist_tracks = get_playlist_tracks(sp, playlist_id, logger)
-            all_tracks.update(playlist_tracks)
+        logger.info(f"Checking {len(source_playlist_ids)} source playlist(s)")
+
+        # Fetch playlists concurrently, but merge into the filter on this
+        # thread since it isn't safe for concurrent writes
+        with ThreadPoolExecutor(max_workers=MAX_PLAYLIST_WORKERS) as executor:
+            for playlist_id, track_ids in zip(source_playlist_ids, executor.map(
+                lambda pid: list(iter_playlist_track_ids(sp, pid, logger)),
+                source_playlist_ids
+            )):
+                logger.info(f"Found {len(track_ids)} tracks in playlist ID: {playlist_id}")
+                all_tracks.update(track_ids)
 
     logger.info(f"Total unique tracks in library: {len(all_tracks)}")
     return all_tracks
 
-def get_album_tracks(sp, album_id):
-    """Get all track IDs from an album"""
-    tracks = []
-    results = sp.album_tracks(album_id, limit=50)
-    tracks.extend(results['items'])
+def get_albums_tracks(sp, album_ids):
+    """Get track IDs for several albums, fetching uncached albums in batches of 20"""
+    album_tracks = {}
+
+    with closing(open_album_cache()) as cache:
+        for album_id in album_ids:
+            track_ids = get_cached_album_tracks(cache, album_id)
+            if track_ids is not None:
+                album_tracks[album_id] = track_ids
+
+        uncached_ids = [album_id for album_id in album_ids if album_id not in album_tracks]
+        for i in range(0, len(uncached_ids), ALBUMS_BATCH_SIZE):
+            batch = uncached_ids[i:i + ALBUMS_BATCH_SIZE]
+            for album in spotify_call(sp.albums, batch)['albums']:
+                if not album:
+                    continue
+
+                tracks = album['tracks']
+                track_ids = [sys.intern(track['id']) for track in tracks['items']]
+                # Albums with more than 50 tracks continue from the embedded page
+                while tracks['next']:
+                    tracks = spotify_call(sp.next, tracks)
+                    track_ids.extend(sys.intern(track['id']) for track in tracks['items'])
+
+                cache_album_tracks(cache, album['id'], track_ids)
+                album_tracks[album['id']] = track_ids
+
+    return album_tracks
 
-    while results['next']:
-        results = sp.next(results)
-        tracks.extend(results['items'])
+def get_user_playlists_by_name(sp):
+    """Get a {name: id} map of all the user's playlists"""
+    playlists = {}
+    pages = iter_pages(lambda offset: sp.current_user_playlists(limit=50, offset=offset), 50)
+    for results in pages:
+        for playlist in results['items']:
+            # Keep the first match, same as a top-to-bottom scan would
+            playlists.setdefault(playlist['name'], playlist['id'])
 
-    return [track['id'] for track in tracks]
+    return playlists
 
 def create_or_get_playlist(sp, playlist_name, logger):
     """Create a new playlist or get existing one"""
-    user_id = sp.current_user()['id']
-    playlists = sp.current_user_playlists(limit=50)
+    user_id = spotify_call(sp.current_user)['id']
+    cache_file = f"playlists_{user_id}.json"
+
+    # Try the cached id first, confirming it still points at the right playlist.
+    # Spotify keeps serving a playlist after the user deletes (unfollows) it,
+    # so it must also still be followed to count as theirs.
+    cached_id = (load_json_cache(cache_file) or {}).get(playlist_name)
+    if cached_id:
+        try:
+            if (spotify_call(sp.playlist, cached_id, fields='id,name')['name'] == playlist_name
+                    and spotify_call(sp.playlist_is_following, cached_id, [user_id])[0]):
+                logger.info(f"Using existing playlist: {playlist_name}")
+                return cached_id
+        except spotipy.SpotifyException as e:
+            logger.warning(f"Cached playlist {cached_id} is no longer valid: {e}")
 
     # Check if playlist already exists
-    for playlist in playlists['items']:
-        if playlist['name'] == playlist_name:
-            logger.info(f"Using existing playlist: {playlist_name}")
-            return playlist['id']
+    playlists = get_user_playlists_by_name(sp)
+    if playlist_name in playlists:
+        logger.info(f"Using existing playlist: {playlist_name}")
+        save_json_cache(cache_file, playlists)
+        return playlists[playlist_name]
 
     # Create new playlist if it doesn't exist
     logger.info(f"Creating new playlist: {playlist_name}")
-    playlist = sp.user_playlist_create(
+    playlist = spotify_call(
+        sp.user_playlist_create,
         user_id,
         playlist_name,
         public=False,
         description='New releases from artists I follow'
     )
+    playlists[playlist_name] = playlist['id']
+    save_json_cache(cache_file, playlists)
     return playlist['id']
 
 def main():
@@ -208,16 +400,16 @@ def main():
         # Find new releases
         new_tracks_to_add = set()  # Use set to avoid duplicates
         albums_processed = set()  # Track processed albums to avoid duplicates
-        albums_found = 0
+        new_albums = []
 
         logger.info("")
         logger.info("Checking for new releases...")
         logger.info("-" * 60)
 
-        for i, artist in enumerate(artists, 1):
-            logger.info(f"[{i}/{len(artists)}] Checking {artist['name']}...")
+        all_new_releases = get_all_artist_new_releases(sp, artists, since_date)
 
-            new_releases = get_artist_new_releases(sp, artist['id'], since_date)
+        for i, (artist, new_releases) in enumerate(zip(artists, all_new_releases), 1):
+            logger.info(f"[{i}/{len(artists)}] Checking {artist['name']}...")
 
             for album in new_releases:
                 # Skip if we've already processed this album
@@ -226,19 +418,22 @@ def main():
                     continue
 
                 albums_processed.add(album['id'])
-                albums_found += 1
+                new_albums.append(album)
                 logger.info(f"  [+] Found: {album['name']} ({album['release_date']})")
-                album_tracks = get_album_tracks(sp, album['id'])
 
-                # Filter out tracks already in library
-                new_tracks = [tid for tid in album_tracks if tid not in library_tracks]
-                new_tracks_to_add.update(new_tracks)
+        # Fetch tracks for every unique album at once
+        album_tracks = get_albums_tracks(sp, [album['id'] for album in new_albums])
+
+        for album in new_albums:
+            # Filter out tracks already in library
+            new_tracks = [tid for tid in album_tracks.get(album['id'], []) if tid not in library_tracks]
+            new_tracks_to_add.update(new_tracks)
 
-                if new_tracks:
-                    logger.info(f"    -> {len(new_tracks)} new track(s) to add")
+            if new_tracks:
+                logger.info(f"  {album['name']} -> {len(new_tracks)} new track(s) to add")
 
         logger.info("-" * 60)
-        logger.info(f"Summary: Found {albums_found} new release(s)")
+        logger.info(f"Summary: Found {len(new_albums)} new release(s)")
 
         # Add tracks to playlist (Spotify API limits to 100 tracks per request)
         if new_tracks_to_add:
@@ -247,7 +442,7 @@ def main():
             logger.info(f"Adding {len(tracks_list)} new tracks to playlist...")
             for i in range(0, len(tracks_list), 100):
                 batch = tracks_list[i:i+100]
-                sp.playlist_add_items(playlist_id, batch)
+                spotify_call(sp.playlist_add_items, playlist_id, batch)
                 logger.info(f"  Added batch {i//100 + 1} ({len(batch)} tracks)")
             logger.info("[SUCCESS] Successfully added all tracks!")
         else:
@@ -1,40 +1,71 @@
-import spotipy
-from spotipy.oauth2 import SpotifyOAuth
-from datetime import datetime, timedelta
+from spotify_client import (
+    CACHE_DIR, SOURCE_PLAYLIST_IDS, get_client, iter_pages, load_json_cache, save_json_cache, spotify_call
+)
+from datetime import datetime, timedelta, timezone
 from os import getenv, makedirs
 from os.path import join
 from dotenv import load_dotenv
 import time
 import pylast
 import logging
+from logging.handlers import MemoryHandler, QueueHandler, QueueListener
+import queue
+import atexit
 import random
-from collections import defaultdict
-from functools import wraps
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import threading
+from functools import lru_cache, partial, wraps
+from dataclasses import dataclass
+from operator import attrgetter
+from concurrent.futures import ThreadPoolExecutor
+import sys
+import heapq
+import math
+import argparse
+import shutil
+from hashlib import blake2b
 
 load_dotenv()
 
-CLIENT_ID = getenv('CLIENT_ID')
-CLIENT_SECRET = getenv('CLIENT_SECRET')
-REDIRECT_URI = getenv('REDIRECT_URI')
 LASTFM_API_KEY = getenv('LASTFM_API_KEY')
 LASTFM_USERNAME = getenv('LASTFM_USERNAME')
 
-sp = spotipy.Spotify(auth_manager=SpotifyOAuth(
-    client_id=CLIENT_ID,
-    client_secret=CLIENT_SECRET,
-    redirect_uri=REDIRECT_URI,
-    scope='user-follow-read user-library-read playlist-modify-public playlist-modify-private'
-))
+sp = get_client()
 
 network = pylast.LastFMNetwork(
     api_key=LASTFM_API_KEY,
     username=LASTFM_USERNAME
 )
 
-date_format = '%Y-%m-%dT%H:%M:%SZ'
-library_lock = threading.Lock()
+# Only request the parts of each playlist item that are actually used
+PLAYLIST_TRACK_FIELDS = 'total,items(added_at,track(uri,name,artists(name)))'
+# Playlists fetched at once while building the library
+MAX_PLAYLIST_WORKERS = 5
+# Placeholder for a missing artist or track name
+UNKNOWN = 'Unknown'
+# Most tracks a Spotify playlist can hold
+MAX_PLAYLIST_SIZE = 10_000
+# Tracks per Last.fm top tracks page, the most the API returns at once
+LASTFM_PAGE_SIZE = 1000
+# Last.fm top tracks pages fetched at once
+MAX_LASTFM_PAGE_WORKERS = 4
+# Seconds before cached Last.fm playcounts are brought up to date with recent scrobbles
+LASTFM_CACHE_TTL = 3600
+# Seconds before cached Last.fm playcounts are rebuilt from scratch, correcting any drift
+LASTFM_FULL_REFRESH_AGE = 7 * 24 * 3600
+# Snapshot of liked songs, extended with new likes on each run
+LIKED_SONGS_CACHE = 'liked_songs.json'
+# Seconds before the liked songs snapshot is rebuilt, catching an unlike offset by a new like
+LIKED_SONGS_FULL_REFRESH_AGE = 7 * 24 * 3600
+
+
+@dataclass(slots=True)
+class Track:
+    """A library track; slots keep it much smaller than the equivalent dict"""
+    uri: str
+    name: str
+    artist: str
+    key: int
+    added_at: datetime | None = None
+    playcount: int = 0
 
 
 class PrintAndLogHandler(logging.Handler):
@@ -59,16 +90,26 @@ formatter = logging.Formatter('%(message)s')
 # File handler with unique filename and UTF-8 encoding
 file_handler = logging.FileHandler(log_file, encoding='utf-8')
 file_handler.setFormatter(formatter)
+# Batch file writes; errors and interpreter exit flush the buffer
+buffered_file_handler = MemoryHandler(capacity=1000, target=file_handler)
 
 # Custom print handler
 print_handler = PrintAndLogHandler()
 print_handler.setFormatter(formatter)
 
-# Setup logger
+# Setup logger; records are handed to a background thread so workers never block on I/O
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, buffered_file_handler, print_handler)
+log_listener.start()
+# Registered after logging's own shutdown hook, so this runs first and the
+# queue is drained before the file buffer is flushed
+atexit.register(log_listener.stop)
+
 logger = logging.getLogger('smart_playlists')
 logger.setLevel(logging.INFO)
-logger.addHandler(file_handler)
-logger.addHandler(print_handler)
+logger.addHandler(QueueHandler(log_queue))
+# Rate limit warnings from the shared Spotify helpers go to the same log
+logging.getLogger('spotify_client').addHandler(QueueHandler(log_queue))
 
 def retry_on_rate_limit(max_retries=3, initial_delay=1):
     def decorator(func):
@@ -97,37 +138,106 @@ def retry_on_rate_limit(max_retries=3, initial_delay=1):
         return wrapper
     return decorator
 
-def get_all_playlist_tracks(playlist_id):
+def _fetch_playlist_tracks(playlist_id, snapshot_id=None):
+    """Get all tracks in a playlist, reusing the cached copy while its snapshot is unchanged
+
+    Callers that already fetched the playlist can pass its snapshot_id to
+    skip looking it up again. Raises if any part of the playlist can't be read.
+    """
     tracks = []
-    offset = 0
     limit = 100
-    while True:
-        try:
-            results = sp.playlist_tracks(playlist_id, offset=offset, limit=limit)
-            tracks.extend([item for item in results['items'] if item and item.get('track')])
-            if not results['next']:
-                break
-            offset += limit
-            # Removed time.sleep(0.1) as Spotipy handles retries/rate limits
-        except Exception as e:
-            logger.exception(f"Error fetching playlist tracks: {e}")
-            break
+    cache_file = f'playlist_{playlist_id}.json'
+
+    def fetch_page(offset):
+        return sp.playlist_tracks(playlist_id, fields=PLAYLIST_TRACK_FIELDS, offset=offset, limit=limit)
+
+    # The snapshot id changes whenever the playlist's contents do
+    if not snapshot_id:
+        snapshot_id = spotify_call(sp.playlist, playlist_id, fields='snapshot_id').get('snapshot_id')
+    cached = load_json_cache(cache_file)
+    if snapshot_id and cached and cached['snapshot_id'] == snapshot_id:
+        return cached['tracks']
+
+    for results in iter_pages(fetch_page, limit):
+        tracks.extend([item for item in results['items'] if item and item.get('track')])
+
+    if snapshot_id:
+        save_json_cache(cache_file, {'snapshot_id': snapshot_id, 'tracks': tracks})
     return tracks
 
-def get_liked_songs():
-    liked_tracks = []
-    offset = 0
-    limit = 50
+def get_all_playlist_tracks(playlist_id, snapshot_id=None):
+    """Get all tracks in a playlist, or an empty list if it can't be read"""
+    try:
+        return _fetch_playlist_tracks(playlist_id, snapshot_id)
+    except Exception as e:
+        logger.exception(f"Error fetching playlist tracks: {e}")
+        return []
+
+def _compact_saved_item(item):
+    """Keep only the parts of a saved-track item the library uses"""
+    track = item['track']
+    return {
+        'track': {
+            'uri': track['uri'],
+            'name': track.get('name'),
+            'artists': [{'name': artist['name']} for artist in track.get('artists', [])[:1]]
+        },
+        'added_at': item['added_at']
+    }
+
+def _iter_new_liked_songs(fetch_page, first_page, limit, known_uris):
+    """Yield liked songs newest first until reaching one that is already known"""
+    page, offset = first_page, 0
     while True:
-        results = sp.current_user_saved_tracks(limit=limit, offset=offset)
-        if not results['items']:
-            break
-        liked_tracks.extend([{
-            'track': item['track'],
-            'added_at': item['added_at']
-        } for item in results['items']])
+        for item in page['items']:
+            if item['track']['uri'] in known_uris:
+                return
+            yield item
         offset += limit
-    return liked_tracks
+        if offset >= page['total']:
+            return
+        page = fetch_page(offset)
+
+def _iter_liked_songs():
+    """Yield liked songs, only fetching the ones liked since the cached snapshot
+
+    Liked songs come back newest first, so new likes are all on the first
+    pages. The cached snapshot is only trusted while the new likes plus the
+    cached ones add up to Spotify's total (nothing was unliked) and it is
+    less than LIKED_SONGS_FULL_REFRESH_AGE old; otherwise everything is
+    fetched again.
+    """
+    limit = 50
+
+    def fetch_page(offset):
+        return sp.current_user_saved_tracks(limit=limit, offset=offset)
+
+    cached = load_json_cache(LIKED_SONGS_CACHE)
+    started_at = time.time()
+
+    if cached and started_at - cached['fetched_at'] < LIKED_SONGS_FULL_REFRESH_AGE:
+        fetch_paced = partial(spotify_call, fetch_page)
+        first_page = fetch_paced(0)
+        known_uris = {item['track']['uri'] for item in cached['items']}
+        new_items = [
+            _compact_saved_item(item)
+            for item in _iter_new_liked_songs(fetch_paced, first_page, limit, known_uris)
+        ]
+        if len(new_items) + len(cached['items']) == first_page['total']:
+            items = new_items + cached['items']
+            if new_items:
+                save_json_cache(LIKED_SONGS_CACHE, {'fetched_at': cached['fetched_at'], 'items': items})
+            yield from items
+            return
+        logger.info("Liked songs were removed since the last run, fetching them all again")
+
+    items = []
+    for results in iter_pages(fetch_page, limit):
+        for item in results['items']:
+            item = _compact_saved_item(item)
+            items.append(item)
+            yield item
+    save_json_cache(LIKED_SONGS_CACHE, {'fetched_at': started_at, 'items': items})
 
 def update_recent_tracks_playlist(full_library, target_playlist_name):
     """Update Recently Added playlist based on pre-fetched library"""
@@ -141,85 +251,154 @@ def update_recent_tracks_playlist(full_library, target_playlist_name):
     one_month_ago = datetime.now() - timedelta(days=30)
     logger.info(f"Filtering for tracks added since {one_month_ago.date()}")
 
-    recent_tracks = [
-        track for track in full_library.values()
-        if track['added_at'] and track['added_at'] > one_month_ago
-    ]
+    # Only (added_at, uri) pairs are needed, so compare plain tuples instead of
+    # going through a key function for every track
+    recent_tracks = (
+        (track.added_at, track.uri) for track in full_library.values()
+        if track.added_at and track.added_at > one_month_ago
+    )
 
-    # 3. Sort by added_at descending
-    sorted_tracks = sorted(recent_tracks, key=lambda x: x['added_at'], reverse=True)
-    recent_uris = [track['uri'] for track in sorted_tracks]
+    # 3. Keep the newest tracks that fit in a playlist, sorted by added_at descending
+    recent_uris = [uri for _, uri in heapq.nlargest(MAX_PLAYLIST_SIZE, recent_tracks)]
 
     # 4. Update the playlist
     create_or_update_playlist(target_playlist_name, recent_uris)
 
-def _create_track_dict(track, added_at=None):
-    """Create a standardized track dictionary"""
-    if not track or not track.get('uri'):
+def _parse_spotify_timestamp(timestamp):
+    """Parse a Spotify 'YYYY-MM-DDTHH:MM:SSZ' timestamp, much faster than strptime
+
+    Anything not in that exact layout falls back to the general ISO 8601 parser.
+    """
+    if len(timestamp) == 20 and timestamp[-1] == 'Z':
+        # fromisoformat is implemented in C; dropping the 'Z' keeps it working on 3.10
+        return datetime.fromisoformat(timestamp[:-1])
+
+    # Python 3.10's fromisoformat doesn't accept a 'Z' suffix
+    parsed = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    return parsed.astimezone(timezone.utc).replace(tzinfo=None) if parsed.tzinfo else parsed
+
+def _track_key(artist, name):
+    """Stable 64-bit key for an artist/title pair, matched case-insensitively
+
+    An int takes far less memory than the joined strings, and unlike hash()
+    it is the same in every run so cached playcounts stay valid.
+    """
+    digest = blake2b(f"{artist.lower()}\0{name.lower()}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+def _create_track(track, added_at=None):
+    """Create a Track from a Spotify track object, or None if it has no URI"""
+    # Subscripting inside try is cheaper than chained .get() for the common complete track
+    try:
+        uri = track['uri']
+    except (KeyError, TypeError):
+        return None
+    if not uri:
         return None
 
-    artist = track['artists'][0]['name'] if track.get('artists') else 'Unknown'
-    name = track.get('name', 'Unknown')
+    # Intern strings shared by many tracks (artist names, URIs repeated across playlists)
+    try:
+        artist = sys.intern(track['artists'][0]['name'])
+    except (KeyError, IndexError, TypeError):
+        artist = UNKNOWN
+    try:
+        name = track['name']
+    except KeyError:
+        name = UNKNOWN
 
     dt_added_at = None
     if added_at:
         if isinstance(added_at, str):
-            dt_added_at = datetime.strptime(added_at, date_format)
+            dt_added_at = _parse_spotify_timestamp(added_at)
         else:
             dt_added_at = added_at
 
-    return {
-        'uri': track['uri'],
-        'name': name,
-        'artist': artist,
-        'added_at': dt_added_at,
-        'key': f"{artist.lower()}|||{name.lower()}"
-    }
+    return Track(
+        uri=sys.intern(uri),
+        name=name,
+        artist=artist,
+        key=_track_key(artist, name),
+        added_at=dt_added_at
+    )
 
 def _update_library_with_track_item(all_tracks, item):
     """Update library map with a single track item, keeping the oldest added_at date"""
-    if not item or not item.get('track'):
-        return
-
-    track_dict = _create_track_dict(item['track'], item.get('added_at'))
-    if not track_dict:
+    track = item.get('track') if item else None
+    if not track or not track.get('uri'):
         return
 
-    uri = track_dict['uri']
-    new_date = track_dict['added_at']
+    added_at = item.get('added_at')
 
-    with library_lock:
-        if uri not in all_tracks:
-            all_tracks[uri] = track_dict
-            return
+    existing = all_tracks.get(track['uri'])
+    if existing is None:
+        track_obj = _create_track(track, added_at)
+        all_tracks[track_obj.uri] = track_obj
+        return
 
-        # If it exists, check if the new date is older
-        existing_date = all_tracks[uri].get('added_at')
-        if new_date and (not existing_date or new_date < existing_date):
-            all_tracks[uri]['added_at'] = new_date
+    # A track seen before only needs its date compared, not a new Track
+    if added_at:
+        new_date = _parse_spotify_timestamp(added_at) if isinstance(added_at, str) else added_at
+        _keep_oldest_date(existing, new_date)
+
+def _keep_oldest_date(track, added_at):
+    """Move a track's added_at back to added_at if that is earlier"""
+    if added_at and (not track.added_at or added_at < track.added_at):
+        track.added_at = added_at
+
+def _merge_library(all_tracks, other_tracks):
+    """Merge another library map into all_tracks, keeping the oldest added_at dates"""
+    for uri, track in other_tracks.items():
+        existing = all_tracks.get(uri)
+        if existing is None:
+            all_tracks[uri] = track
+        else:
+            _keep_oldest_date(existing, track.added_at)
 
 def _add_liked_songs_to_library(all_tracks):
     """Add liked songs to the track library, keeping the oldest added_at date"""
     logger.info("Fetching liked songs...")
-    liked = get_liked_songs()
 
-    for item in liked:
+    # Ingest each page as it arrives rather than holding the whole list
+    for item in _iter_liked_songs():
         _update_library_with_track_item(all_tracks, item)
 
     logger.info(f"Unique tracks after Liked Songs: {len(all_tracks)}")
+    return all_tracks
+
+def _fetch_playlist_items(playlist_id, playlist=None):
+    """Fetch the track items of one playlist, returning an empty list on failure
+
+    playlist is its entry from the user's playlist listing, when it has one.
+    """
+    try:
+        if playlist is None:
+            # One lookup gives both the name to log and the snapshot for the cache check
+            playlist = spotify_call(sp.playlist, playlist_id, fields='name,snapshot_id')
+        logger.info(f"Fetching tracks from: {playlist['name']}")
+        return get_all_playlist_tracks(playlist_id, playlist.get('snapshot_id'))
+    except Exception as e:
+        logger.exception(f"Error processing playlist {playlist_id}: {e}")
+        return []
 
 def _add_playlist_tracks_to_library(all_tracks, playlist_ids):
     """Add playlist tracks to the track library, keeping the oldest added_at date"""
-    for playlist_id in playlist_ids:
-        try:
-            playlist = sp.playlist(playlist_id)
-            logger.info(f"Fetching tracks from: {playlist['name']}")
-            tracks = get_all_playlist_tracks(playlist_id)
+    # The user's own and followed playlists already come with their name and
+    # snapshot in the listing, so only other playlists need a lookup each
+    try:
+        listed = {playlist['id']: playlist for playlist in _get_user_playlists()}
+    except Exception as e:
+        logger.exception(f"Error listing user playlists: {e}")
+        listed = {}
 
-            for item in tracks:
-                _update_library_with_track_item(all_tracks, item)
-        except Exception as e:
-            logger.exception(f"Error processing playlist {playlist_id}: {e}")
+    # Playlists are fetched concurrently and merged here as each one arrives
+    with ThreadPoolExecutor(max_workers=MAX_PLAYLIST_WORKERS) as executor:
+        results = executor.map(lambda pid: _fetch_playlist_items(pid, listed.get(pid)), playlist_ids)
+        for playlist_id, tracks in zip(playlist_ids, results):
+            try:
+                for item in tracks:
+                    _update_library_with_track_item(all_tracks, item)
+            except Exception as e:
+                logger.exception(f"Error processing playlist {playlist_id}: {e}")
 
 def get_all_spotify_library_tracks(playlist_ids):
     """Get all unique tracks from Spotify library using parallel fetching"""
@@ -228,58 +407,138 @@ def get_all_spotify_library_tracks(playlist_ids):
 
     all_tracks = {}
 
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        # Submit task for liked songs
-        future_to_type = {executor.submit(_add_liked_songs_to_library, all_tracks): "liked_songs"}
-
-        # Submit tasks for each playlist
-        for playlist_id in playlist_ids:
-            future_to_type[executor.submit(_add_playlist_tracks_to_library, all_tracks, [playlist_id])] = f"playlist_{playlist_id}"
-
-        for future in as_completed(future_to_type):
-            task_type = future_to_type[future]
-            try:
-                future.result()
-            except Exception as e:
-                logger.exception(f"Task {task_type} generated an exception: {e}")
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # Liked songs stream into their own map alongside the playlists, so
+        # neither side needs a lock, and the two are merged once at the end
+        liked_songs = executor.submit(_add_liked_songs_to_library, {})
+        _add_playlist_tracks_to_library(all_tracks, playlist_ids)
+        try:
+            _merge_library(all_tracks, liked_songs.result())
+        except Exception as e:
+            logger.exception(f"Task liked_songs generated an exception: {e}")
 
     elapsed = time.time() - start_time
     logger.info(f"\nTotal unique tracks in library: {len(all_tracks)}")
     logger.info(f"Library build completed in {format_elapsed_time(elapsed)}\n")
     return all_tracks
 
+@lru_cache(maxsize=1)
+def _get_lastfm_user():
+    """Return the Last.fm user object, built once and reused"""
+    return network.get_user(LASTFM_USERNAME)
+
+# Different Spotify releases of a song share an artist and title, so repeat lookups hit memory.
+# Errors are raised rather than returned, so they reach the retry and are never cached.
+@lru_cache(maxsize=50_000)
 @retry_on_rate_limit()
+def _fetch_lastfm_track_playcount(artist, track):
+    """Fetch the user's playcount for a specific track from Last.fm"""
+    try:
+        playcount = network.get_track(artist, track).get_userplaycount()
+    except pylast.WSError as e:
+        if str(e.status) == "6":  # Track not found, so it has never been played
+            return 0
+        raise
+    return playcount if playcount else 0
+
 def get_lastfm_track_playcount(artist, track):
-    """Get playcount for a specific track from Last.fm"""
+    """Get playcount for a specific track from Last.fm, or None if it couldn't be fetched"""
     try:
-        lastfm_track = network.get_track(artist, track)
-        playcount = lastfm_track.get_userplaycount()
-        return playcount if playcount else 0
+        return _fetch_lastfm_track_playcount(artist, track)
     except Exception:
-        return 0
+        return None
+
+def _add_recent_scrobbles(user, playcounts, since):
+    """Add one play for every track scrobbled since the given Unix time"""
+    for played in user.get_recent_tracks(limit=None, time_from=since, stream=True):
+        key = _track_key(played.track.artist.name, played.track.title)
+        playcounts[key] = playcounts.get(key, 0) + 1
+
+def _request_top_tracks_page(user, page):
+    """Request one page of the user's top tracks as (total pages, [(artist, title, playcount)])
+
+    pylast's own paging asks for 50 tracks at a time and walks the pages one
+    by one, so the request is made directly to fetch full pages concurrently.
+    This is the only place relying on pylast internals (User._get_params and
+    _request, _extract, _number), which may change in any pylast release.
+    """
+    params = {**user._get_params(), 'period': pylast.PERIOD_OVERALL, 'limit': LASTFM_PAGE_SIZE, 'page': page}
+    doc = user._request('user.getTopTracks', True, params)
+    top_tracks = doc.getElementsByTagName('toptracks')[0]
+    total_pages = int(top_tracks.getAttribute('totalPages') or 1)
+    tracks = [
+        # The first <name> is the track's, the second its artist's
+        (pylast._extract(node, 'name', 1), pylast._extract(node, 'name'),
+         pylast._number(pylast._extract(node, 'playcount')))
+        for node in top_tracks.getElementsByTagName('track')
+    ]
+    return total_pages, tracks
+
+@retry_on_rate_limit()
+def _fetch_top_tracks_page(user, page):
+    """Fetch one page of the user's top tracks, retried on rate limits"""
+    return _request_top_tracks_page(user, page)
+
+def _fetch_top_track_playcounts(user):
+    """Fetch the user's playcount for every track they have scrobbled
+
+    The first page gives the page count, then the rest are fetched
+    concurrently, each retried on its own if it hits a rate limit.
+    """
+    total_pages, tracks = _fetch_top_tracks_page(user, 1)
+    pages = [tracks]
+    if total_pages > 1:
+        with ThreadPoolExecutor(max_workers=MAX_LASTFM_PAGE_WORKERS) as executor:
+            pages.extend(executor.map(lambda page: _fetch_top_tracks_page(user, page)[1], range(2, total_pages + 1)))
 
-def get_all_lastfm_playcounts():
-    """Fetch all playcounts from Last.fm library in bulk using streaming API"""
-    logger.info("=== Fetching all Last.fm playcounts in bulk ===")
-    user = network.get_user(LASTFM_USERNAME)
     playcounts = {}
+    for tracks in pages:
+        for artist, title, playcount in tracks:
+            # Since we could potentially get thousands of tracks, we only store the weight
+            playcounts[_track_key(artist, title)] = int(playcount)
+    return playcounts
 
-    try:
-        # pylast v7.x provides a streaming generator that handles pagination automatically.
-        # We iterate over this to get all tracks without manual page management.
-        top_tracks = user.get_top_tracks(period=pylast.PERIOD_OVERALL, stream=True)
+def get_all_lastfm_playcounts():
+    """Fetch all playcounts from Last.fm library in bulk
 
-        for top_track in top_tracks:
-            artist = top_track.item.artist.name.lower()
-            track_name = top_track.item.title.lower()
-            key = f"{artist}|||{track_name}"
+    Cached playcounts are reused for an hour, then brought up to date from
+    the scrobbles since, with a full fetch once the cache is a week old.
+    """
+    logger.info("=== Fetching all Last.fm playcounts in bulk ===")
+    cache_file = f'lastfm_playcounts_{LASTFM_USERNAME}.json'
+    cached = load_json_cache(cache_file)
+    # JSON objects only have string keys, so the int keys are stored as pairs
+    if not (cached and isinstance(cached['playcounts'], list)):
+        cached = None
+    started_at = time.time()
 
-            # Since we could potentially get thousands of tracks, we only store the weight
-            playcounts[key] = int(top_track.weight)
+    if cached and started_at - cached['fetched_at'] < LASTFM_CACHE_TTL:
+        logger.info(f"Using {len(cached['playcounts'])} cached Last.fm playcounts")
+        return dict(cached['playcounts'])
 
-            if len(playcounts) > 0 and len(playcounts) % 500 == 0:
-                logger.info(f"Cached {len(playcounts)} tracks...")
+    user = _get_lastfm_user()
 
+    if cached and started_at - cached.get('full_fetched_at', 0) < LASTFM_FULL_REFRESH_AGE:
+        playcounts = dict(cached['playcounts'])
+        try:
+            _add_recent_scrobbles(user, playcounts, int(cached['fetched_at']))
+        except Exception as e:
+            logger.warning(f"Could not fetch recent scrobbles, fetching all playcounts: {e}")
+        else:
+            save_json_cache(cache_file, {
+                'fetched_at': started_at,
+                'full_fetched_at': cached['full_fetched_at'],
+                'playcounts': list(playcounts.items())
+            })
+            logger.info(f"Updated {len(playcounts)} cached Last.fm playcounts with recent scrobbles")
+            return playcounts
+
+    # A failed fetch falls back to the previous playcounts, however old,
+    # rather than emptying the playcount playlists
+    playcounts = dict(cached['playcounts']) if cached else {}
+
+    try:
+        playcounts = _fetch_top_track_playcounts(user)
     except pylast.WSError as e:
         if str(e.status) == "29":  # Rate limit exceeded
             logger.warning("Rate limit hit during bulk fetch.")
@@ -287,6 +546,13 @@ def get_all_lastfm_playcounts():
             logger.exception(f"Error during bulk fetch: {e}")
     except Exception as e:
         logger.exception(f"Error during bulk fetch: {e}")
+    else:
+        # Only a complete fetch is worth reusing
+        save_json_cache(cache_file, {
+            'fetched_at': started_at,
+            'full_fetched_at': started_at,
+            'playcounts': list(playcounts.items())
+        })
 
     logger.info(f"Successfully cached {len(playcounts)} tracks from Last.fm")
     return playcounts
@@ -298,59 +564,140 @@ def match_spotify_with_lastfm(spotify_tracks):
     # Pre-fetch all Last.fm playcounts
     lastfm_library = get_all_lastfm_playcounts()
 
-    matched_tracks = []
-    total = len(spotify_tracks)
-    missing_tracks = []
-
-    for idx, (uri, track_data) in enumerate(spotify_tracks.items(), 1):
-        artist = track_data['artist'].lower()
-        name = track_data['name'].lower()
-        key = f"{artist}|||{name}"
-
-        playcount = lastfm_library.get(key)
+    matched_tracks = list(spotify_tracks.values())
+    missing = 0
 
+    # Tight loop with no per-track logging; only totals are reported
+    get_playcount = lastfm_library.get
+    for track in matched_tracks:
+        # The lookup key is computed once when the track is ingested
+        playcount = get_playcount(track.key)
         if playcount is None:
             # If not in top tracks, it might have 0 plays or be hard to match
-            # We'll collect these for a second pass or just default to 0
             playcount = 0
-            missing_tracks.append(track_data)
-
-        matched_tracks.append({
-            'uri': uri,
-            'name': track_data['name'],
-            'artist': track_data['artist'],
-            'playcount': playcount
-        })
-
-        if idx % 100 == 0:
-            logger.info(f"Processed {idx}/{total} tracks...")
+            missing += 1
+        # Record the playcount on the library Track itself instead of copying it
+        track.playcount = playcount
 
     logger.info(f"\nMatched {len(matched_tracks)} tracks with Last.fm data")
-    if missing_tracks:
-        logger.info(f"Note: {len(missing_tracks)} tracks were not found in Last.fm library (0 plays assumed)")
+    if missing:
+        logger.info(f"Note: {missing} tracks were not found in Last.fm library (0 plays assumed)")
 
     return matched_tracks
 
+def _add_playlist_items(playlist_id, track_uris, position=None):
+    """Add tracks to a playlist in batches of 100, optionally starting at position"""
+    batch_size = 100
+    for i in range(0, len(track_uris), batch_size):
+        batch = track_uris[i:i + batch_size]
+        if position is None:
+            spotify_call(sp.playlist_add_items, playlist_id, batch)
+        else:
+            spotify_call(sp.playlist_add_items, playlist_id, batch, position=position + i)
+
+def _replace_playlist_items(playlist_id, track_uris):
+    """Overwrite a playlist with track_uris, returning how many tracks were written"""
+    # The replace itself carries the first batch, so it costs no extra request
+    spotify_call(sp.playlist_replace_items, playlist_id, track_uris[:100])
+    _add_playlist_items(playlist_id, track_uris[100:])
+    return len(track_uris)
+
+def _sync_playlist_items(playlist_id, track_uris):
+    """Apply only the additions/removals needed to make a playlist match track_uris
+
+    Falls back to a full replace when the kept tracks changed order, when
+    that would take fewer requests than the diff, or when the current
+    contents can't be read in full.
+    """
+    try:
+        current_uris = [item['track']['uri'] for item in _fetch_playlist_tracks(playlist_id)]
+    except Exception as e:
+        # Diffing against a partial read would add back tracks that are already there
+        logger.warning(f"Could not read playlist {playlist_id}, replacing its contents: {e}")
+        return _replace_playlist_items(playlist_id, track_uris), 0
+
+    if current_uris == track_uris:
+        return 0, 0
+
+    wanted = set(track_uris)
+    current = set(current_uris)
+    to_remove = [uri for uri in dict.fromkeys(current_uris) if uri not in wanted]
+
+    # Group new tracks into runs of consecutive positions in the final order
+    insertions = []
+    for index, uri in enumerate(track_uris):
+        if uri in current:
+            continue
+        if insertions and insertions[-1][0] + len(insertions[-1][1]) == index:
+            insertions[-1][1].append(uri)
+        else:
+            insertions.append((index, [uri]))
+
+    kept_in_order = (
+        [uri for uri in current_uris if uri in wanted] == [uri for uri in track_uris if uri in current]
+    )
+    diff_requests = math.ceil(len(to_remove) / 100) + sum(math.ceil(len(run) / 100) for _, run in insertions)
+    replace_requests = max(1, math.ceil(len(track_uris) / 100))
+
+    if not kept_in_order or diff_requests > replace_requests:
+        return _replace_playlist_items(playlist_id, track_uris), len(current_uris)
+
+    for i in range(0, len(to_remove), 100):
+        spotify_call(sp.playlist_remove_all_occurrences_of_items, playlist_id, to_remove[i:i + 100])
+    # Earlier runs are already in place, so each run's index is its final position
+    for position, run in insertions:
+        _add_playlist_items(playlist_id, run, position=position)
+    return sum(len(run) for _, run in insertions), len(to_remove)
+
+@lru_cache(maxsize=None)
+def _get_user_playlists():
+    """List every playlist the user has (with name, id and snapshot_id), fetched once per run"""
+    limit = 50
+
+    def fetch_page(offset):
+        return sp.current_user_playlists(limit=limit, offset=offset)
+
+    return [playlist for results in iter_pages(fetch_page, limit) for playlist in results['items']]
+
+@lru_cache(maxsize=1)
+def _get_current_user_id():
+    """Return the signed-in user's id, fetched once per run"""
+    return spotify_call(sp.current_user)['id']
+
+@lru_cache(maxsize=None)
+def _get_user_playlist_ids():
+    """Map every playlist the user has to its id"""
+    playlist_ids = {}
+    for playlist in _get_user_playlists():
+        # Keep the first match, same as a top-to-bottom scan would
+        playlist_ids.setdefault(playlist['name'], playlist['id'])
+    return playlist_ids
+
 def create_or_update_playlist(playlist_name, track_uris):
     """Create or update a playlist with given tracks"""
-    playlists = sp.current_user_playlists()['items']
-    target_playlist = next((p for p in playlists if p['name'] == playlist_name), None)
+    playlist_ids = _get_user_playlist_ids()
+    playlist_id = playlist_ids.get(playlist_name)
 
-    if target_playlist:
-        sp.playlist_replace_items(target_playlist['id'], [])
+    if playlist_id:
+        added, removed = _sync_playlist_items(playlist_id, track_uris)
     else:
-        user_id = sp.current_user()['id']
-        target_playlist = sp.user_playlist_create(user_id, playlist_name, public=True)
+        playlist_id = spotify_call(sp.user_playlist_create, _get_current_user_id(), playlist_name, public=True)['id']
+        playlist_ids[playlist_name] = playlist_id
+        _add_playlist_items(playlist_id, track_uris)
+        added, removed = len(track_uris), 0
 
     if track_uris:
-        batch_size = 100
-        for i in range(0, len(track_uris), batch_size):
-            batch = track_uris[i:i + batch_size]
-            sp.playlist_add_items(target_playlist['id'], batch)
-        logger.info(f"Updated '{playlist_name}' with {len(track_uris)} tracks")
+        logger.info(f"Updated '{playlist_name}' with {len(track_uris)} tracks ({added} added, {removed} removed)")
     else:
         logger.info(f"No tracks to add to '{playlist_name}'")
 
+def _format_track_list(tracks):
+    """Format numbered 'artist - name (N plays)' lines for a single log message"""
+    return "\n".join(
+        f"{i}. {track.artist} - {track.name} ({track.playcount} plays)"
+        for i, track in enumerate(tracks, 1)
+    )
+
 def update_playcount_playlists(spotify_library, top_playlist_name, bottom_playlist_name):
     """Create/update playlists using pre-fetched library"""
     logger.info("\n" + "="*50)
@@ -361,41 +708,26 @@ def update_playcount_playlists(spotify_library, top_playlist_name, bottom_playli
     matched_tracks = match_spotify_with_lastfm(spotify_library)
 
     # Filter tracks with at least 1 play
-    played_tracks = [t for t in matched_tracks if t['playcount']]
+    played_tracks = [t for t in matched_tracks if t.playcount]
 
-    # Sort by playcount descending for top 25
-    top_25 = sorted(played_tracks, key=lambda x: x['playcount'], reverse=True)[:25]
+    # Keep only the 25 highest playcounts instead of sorting every track
+    top_25 = heapq.nlargest(25, played_tracks, key=attrgetter('playcount'))
 
-    # Group and shuffle for bottom 25 variety
-    playcount_groups = defaultdict(list)
-    for track in played_tracks:
-        playcount_groups[track['playcount']].append(track)
-
-    bottom_tracks = []
-    # Sort playcounts ascending
-    for pc in sorted(playcount_groups.keys()):
-        group = playcount_groups[pc]
-        random.SystemRandom().shuffle(group)
-        bottom_tracks.extend(group)
-        if len(bottom_tracks) >= 25:
-            break
-
-    bottom_25 = bottom_tracks[:25]
+    # Lowest playcounts first, with a random tiebreak for variety among equal counts.
+    # The tiebreak is cosmetic, so a plain PRNG avoids an os.urandom call per track.
+    rng = random.Random()
+    bottom_25 = heapq.nsmallest(25, played_tracks, key=lambda x: (x.playcount, rng.random()))
 
     # Display and create top 25 playlist
-    logger.info("\n=== Top 25 Most Played Tracks ===")
-    for i, track in enumerate(top_25, 1):
-        logger.info(f"{i}. {track['artist']} - {track['name']} ({track['playcount']} plays)")
+    logger.info(f"\n=== Top 25 Most Played Tracks ===\n{_format_track_list(top_25)}")
 
-    top_track_uris = [t['uri'] for t in top_25]
+    top_track_uris = [t.uri for t in top_25]
     create_or_update_playlist(top_playlist_name, top_track_uris)
 
     # Display and create bottom 25 playlist
-    logger.info("\n=== Top 25 Least Played Tracks ===")
-    for i, track in enumerate(bottom_25, 1):
-        logger.info(f"{i}. {track['artist']} - {track['name']} ({track['playcount']} plays)")
+    logger.info(f"\n=== Top 25 Least Played Tracks ===\n{_format_track_list(bottom_25)}")
 
-    bottom_track_uris = [t['uri'] for t in bottom_25]
+    bottom_track_uris = [t.uri for t in bottom_25]
     create_or_update_playlist(bottom_playlist_name, bottom_track_uris)
 
 def format_elapsed_time(seconds):
@@ -411,10 +743,15 @@ def format_elapsed_time(seconds):
     return " ".join(parts)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Update smart playlists from Spotify and Last.fm')
+    parser.add_argument('--refresh', action='store_true', help='ignore cached responses and fetch everything again')
+    args = parser.parse_args()
+    if args.refresh:
+        shutil.rmtree(CACHE_DIR, ignore_errors=True)
+
     script_start = time.time()
     logger.info(f"Script started at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
 
-    SOURCE_PLAYLIST_IDS = getenv('SOURCE_PLAYLIST_IDS').split(',')
     TARGET_PLAYLIST_NAME = getenv('TARGET_PLAYLIST_NAME')
     TOP_25_PLAYLIST_NAME = getenv('TOP_25_PLAYLIST_NAME', 'Top 25 Most Played')
     BOTTOM_25_PLAYLIST_NAME = getenv('BOTTOM_25_PLAYLIST_NAME', 'Top 25 Least Played')
@@ -0,0 +1,151 @@
+import spotipy
+from spotipy.cache_handler import CacheFileHandler
+from spotipy.oauth2 import SpotifyOAuth
+from requests.adapters import DEFAULT_POOLSIZE
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial, wraps
+import json
+import logging
+import threading
+import time
+from os import getenv, replace
+from pathlib import Path
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+CLIENT_ID = getenv('CLIENT_ID')
+CLIENT_SECRET = getenv('CLIENT_SECRET')
+REDIRECT_URI = getenv('REDIRECT_URI')
+
+# Scopes needed by the playlist scripts
+SCOPE = 'user-follow-read user-library-read playlist-modify-public playlist-modify-private'
+
+# Token cache shared by every script (restored from secrets in the workflows)
+TOKEN_CACHE_PATH = '.cache'
+
+# Requests in flight at once, matching the keep-alive connections requests pools by default
+MAX_CONNECTIONS = DEFAULT_POOLSIZE
+
+# Responses kept between runs
+CACHE_DIR = Path('cache')
+
+# Concurrent page requests per paginated fetch
+MAX_PAGE_WORKERS = 4
+
+# Server errors spotipy's session retries itself. 429 is left out so rate limits
+# reach retry_on_spotify_rate_limit with their Retry-After header intact,
+# instead of being retried blindly and then raised without it.
+RETRY_STATUS_CODES = tuple(code for code in spotipy.Spotify.default_retry_codes if code != 429)
+
+# Requests per second allowed across all concurrent workers, kept under
+# Spotify's ~25/s rolling limit; a 429 beyond that is retried after Retry-After
+MAX_REQUESTS_PER_SECOND = 20
+# Requests that may go out back to back after an idle spell
+MAX_REQUEST_BURST = 20
+
+class RateLimiter:
+    """Token bucket shared across threads: requests are spaced evenly at rate
+    per second, but up to burst of them may go out at once after a pause
+    """
+
+    def __init__(self, rate, burst=1):
+        self.interval = 1 / rate
+        self.burst_window = (burst - 1) * self.interval
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            # Idle time builds up credit, but never more than burst requests' worth
+            start = max(self.next_time, now - self.burst_window)
+            wait_time = start - now
+            self.next_time = start + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+# Shared by every worker in a script so together they stay under the limit
+rate_limiter = RateLimiter(MAX_REQUESTS_PER_SECOND, MAX_REQUEST_BURST)
+
+# Nested page and playlist workers can outnumber the pooled connections, so
+# requests in flight are capped at the pool size instead of opening extra ones
+request_slots = threading.BoundedSemaphore(MAX_CONNECTIONS)
+
+def retry_on_spotify_rate_limit(max_retries=3, initial_delay=1):
+    """Retry a Spotify call on HTTP 429, waiting as long as Retry-After asks"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            for attempt in range(max_retries + 1):
+                try:
+                    return func(*args, **kwargs)
+                except spotipy.SpotifyException as e:
+                    if e.http_status != 429 or attempt == max_retries:
+                        raise
+                    wait_time = int((e.headers or {}).get('Retry-After', initial_delay * 2 ** attempt))
+                    logger.warning(f"Spotify rate limit exceeded. Retrying in {wait_time}s...")
+                    time.sleep(wait_time)
+        return wrapper
+    return decorator
+
+@retry_on_spotify_rate_limit()
+def spotify_call(method, *args, **kwargs):
+    """Make a single Spotify request, paced and retried on rate limits"""
+    rate_limiter.wait()
+    with request_slots:
+        return method(*args, **kwargs)
+
+def iter_pages(fetch_page, limit):
+    """Yield every page of an offset-paginated endpoint in order
+
+    The first page gives the total, so the remaining offsets are known up
+    front and fetched concurrently instead of one round-trip at a time.
+    """
+    # Each page is paced and retried on its own, with the retry wait outside the request cap
+    fetch_limited = partial(spotify_call, fetch_page)
+
+    first_page = fetch_limited(0)
+    yield first_page
+
+    offsets = range(limit, first_page['total'], limit)
+    if offsets:
+        with ThreadPoolExecutor(max_workers=MAX_PAGE_WORKERS) as executor:
+            yield from executor.map(fetch_limited, offsets)
+
+def load_json_cache(filename):
+    """Load a JSON cache file, returning None if it is missing or unreadable"""
+    try:
+        with open(CACHE_DIR / filename, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_json_cache(filename, data):
+    """Atomically write data to a JSON cache file"""
+    CACHE_DIR.mkdir(exist_ok=True)
+    cache_file = CACHE_DIR / filename
+    tmp_file = cache_file.with_suffix('.tmp')
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    replace(tmp_file, cache_file)
+
+def parse_playlist_ids(value):
+    """Split a comma-separated list of playlist IDs, dropping whitespace and blank entries"""
+    return tuple(pid.strip() for pid in value.split(',') if pid.strip())
+
+# Playlists read into the library alongside liked songs, parsed once for every script
+SOURCE_PLAYLIST_IDS = parse_playlist_ids(getenv('SOURCE_PLAYLIST_IDS', ''))
+
+@lru_cache(maxsize=None)
+def get_client(scope=SCOPE):
+    """Return the shared Spotify client for a scope, creating it on first use"""
+    return spotipy.Spotify(auth_manager=SpotifyOAuth(
+        client_id=CLIENT_ID,
+        client_secret=CLIENT_SECRET,
+        redirect_uri=REDIRECT_URI,
+        scope=scope,
+        cache_handler=CacheFileHandler(cache_path=TOKEN_CACHE_PATH)
+    ), status_forcelist=RETRY_STATUS_CODES)
@@ -1,4 +1,5 @@
 import pytest
+import time
 from unittest.mock import MagicMock, patch
 from datetime import datetime, timedelta
 import new_releases
@@ -8,6 +9,12 @@ def mock_sleep():
     with patch('time.sleep', return_value=None):
         yield
 
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path):
+    with patch('spotify_client.CACHE_DIR', tmp_path), \
+         patch('new_releases.CACHE_DIR', tmp_path):
+        yield tmp_path
+
 @pytest.fixture
 def mock_sp():
     return MagicMock()
@@ -16,17 +23,33 @@ def mock_sp():
 def mock_logger():
     return MagicMock()
 
+def test_bloom_filter():
+    bloom = new_releases.BloomFilter(capacity=1000, error_rate=1e-3)
+    added = [f'track{i}' for i in range(1000)]
+    bloom.update(added)
+    bloom.add('track0')
+
+    assert all(track_id in bloom for track_id in added)
+    assert len(bloom) == 1000
+    false_positives = sum(f'other{i}' in bloom for i in range(10000))
+    assert false_positives < 50
+
+def test_get_spotify_client_is_shared():
+    assert new_releases.get_spotify_client() is new_releases.get_spotify_client()
+
 def test_get_followed_artists(mock_sp, mock_logger):
     mock_sp.current_user_followed_artists.return_value = {
         'artists': {
-            'items': [{'name': 'Artist 1'}],
-            'next': 'url'
+            'items': [{'name': 'Artist 1', 'id': 'a1'}],
+            'next': 'url',
+            'total': 2
         }
     }
     mock_sp.next.return_value = {
         'artists': {
-            'items': [{'name': 'Artist 2'}],
-            'next': None
+            'items': [{'name': 'Artist 2', 'id': 'a2'}],
+            'next': None,
+            'total': 2
         }
     }
 
@@ -34,6 +57,48 @@ def test_get_followed_artists(mock_sp, mock_logger):
     assert len(artists) == 2
     assert artists[0]['name'] == 'Artist 1'
     assert artists[1]['name'] == 'Artist 2'
+    assert new_releases.load_json_cache('followed_artists.json')['head_id'] == 'a1'
+
+def test_get_followed_artists_cached(mock_sp, mock_logger):
+    cached_artists = [{'name': 'Artist 1', 'id': 'a1'}, {'name': 'Artist 2', 'id': 'a2'}]
+    new_releases.save_json_cache('followed_artists.json', {
+        'fetched_at': time.time(), 'total': 2, 'head_id': 'a1', 'artists': cached_artists
+    })
+    mock_sp.current_user_followed_artists.return_value = {
+        'artists': {'items': [{'name': 'Artist 1', 'id': 'a1'}], 'next': 'url', 'total': 2}
+    }
+
+    artists = new_releases.get_followed_artists(mock_sp, mock_logger)
+    assert artists == cached_artists
+    mock_sp.current_user_followed_artists.assert_called_once_with(limit=1)
+    mock_sp.next.assert_not_called()
+
+def test_get_followed_artists_cache_mismatch(mock_sp, mock_logger):
+    new_releases.save_json_cache('followed_artists.json', {
+        'fetched_at': time.time(), 'total': 1, 'head_id': 'a1', 'artists': [{'name': 'Artist 1', 'id': 'a1'}]
+    })
+    mock_sp.current_user_followed_artists.return_value = {
+        'artists': {'items': [{'name': 'Artist 3', 'id': 'a3'}], 'next': None, 'total': 1}
+    }
+
+    artists = new_releases.get_followed_artists(mock_sp, mock_logger)
+    assert [a['id'] for a in artists] == ['a3']
+    mock_sp.current_user_followed_artists.assert_called_with(limit=50)
+    assert new_releases.load_json_cache('followed_artists.json')['head_id'] == 'a3'
+
+def test_get_followed_artists_refetches_old_cache(mock_sp, mock_logger):
+    # Same total and first artist, but a week old
+    new_releases.save_json_cache('followed_artists.json', {
+        'fetched_at': time.time() - new_releases.FOLLOWED_ARTISTS_FULL_REFRESH_AGE,
+        'total': 2, 'head_id': 'a1', 'artists': [{'name': 'Artist 1', 'id': 'a1'}, {'name': 'Artist 2', 'id': 'a2'}]
+    })
+    mock_sp.current_user_followed_artists.return_value = {
+        'artists': {'items': [{'name': 'Artist 1', 'id': 'a1'}, {'name': 'Artist 3', 'id': 'a3'}], 'next': None, 'total': 2}
+    }
+
+    artists = new_releases.get_followed_artists(mock_sp, mock_logger)
+    assert [a['id'] for a in artists] == ['a1', 'a3']
+    mock_sp.current_user_followed_artists.assert_called_once_with(limit=50)
 
 def test_get_artist_new_releases(mock_sp):
     mock_sp.artist_albums.return_value = {
@@ -59,28 +124,122 @@ def test_get_artist_new_releases_date_formats(mock_sp):
     releases = new_releases.get_artist_new_releases(mock_sp, 'artist_id', since_date)
     assert len(releases) == 2
 
-def test_get_saved_tracks(mock_sp, mock_logger):
-    mock_sp.current_user_saved_tracks.return_value = {
-        'items': [{'track': {'id': 't1'}}],
-        'next': None
+def test_parse_release_date():
+    assert new_releases.parse_release_date('2026') == datetime(2026, 1, 1)
+    assert new_releases.parse_release_date('2026-02') == datetime(2026, 2, 1)
+    assert new_releases.parse_release_date('2026-02-03') == datetime(2026, 2, 3)
+
+def test_get_artist_new_releases_skips_stale_groups(mock_sp):
+    mock_sp.artist_albums.return_value = {
+        'items': [
+            {'name': 'New Album', 'release_date': '2026-01-27', 'id': 'a1', 'album_group': 'album'},
+            {'name': 'Old Album', 'release_date': '2025-01-01', 'id': 'a2', 'album_group': 'album'},
+            {'name': 'Bad Date Album', 'release_date': 'not-a-date', 'id': 'a3', 'album_group': 'album'},
+            {'name': 'New Single', 'release_date': '2026-01-28', 'id': 's1', 'album_group': 'single'},
+            {'name': 'Old Single', 'release_date': '2024-05', 'id': 's2', 'album_group': 'single'},
+            {'name': 'Bad Date Single', 'release_date': 'not-a-date', 'id': 's3', 'album_group': 'single'}
+        ]
     }
-    track_ids = new_releases.get_saved_tracks(mock_sp, mock_logger)
-    assert 't1' in track_ids
-    assert len(track_ids) == 1
+    since_date = datetime(2026, 1, 20)
+
+    releases = new_releases.get_artist_new_releases(mock_sp, 'artist_id', since_date)
+    assert [r['id'] for r in releases] == ['a1', 's1']
+    mock_sp.artist_albums.assert_called_once_with('artist_id', include_groups='album,single', limit=50)
+
+def test_get_artist_albums_cached(mock_sp):
+    mock_sp.artist_albums.return_value = {
+        'items': [{'name': 'New Album', 'release_date': '2026-01-27', 'id': 'a1',
+                   'album_group': 'album', 'images': [{'url': 'img'}]}]
+    }
+    expected = [{'id': 'a1', 'name': 'New Album', 'release_date': '2026-01-27', 'album_group': 'album'}]
+
+    with patch('new_releases.time.time', return_value=1000.0):
+        assert new_releases.get_artist_albums(mock_sp, 'artist_id') == expected
+    with patch('new_releases.time.time', return_value=1000.0 + new_releases.ARTIST_ALBUMS_TTL - 1):
+        assert new_releases.get_artist_albums(mock_sp, 'artist_id') == expected
+    assert mock_sp.artist_albums.call_count == 1
+
+    # Expired entries are fetched again
+    with patch('new_releases.time.time', return_value=1000.0 + new_releases.ARTIST_ALBUMS_TTL):
+        new_releases.get_artist_albums(mock_sp, 'artist_id')
+    assert mock_sp.artist_albums.call_count == 2
+
+def test_get_all_artist_new_releases_preserves_order(mock_sp):
+    artists = [{'name': f'Artist {i}', 'id': f'aid{i}'} for i in range(10)]
+    since_date = datetime(2026, 1, 20)
+
+    with patch('new_releases.get_artist_new_releases', side_effect=lambda sp, artist_id, since: [artist_id]) as mock_get:
+        releases = new_releases.get_all_artist_new_releases(mock_sp, artists, since_date)
+
+    assert releases == [[f'aid{i}'] for i in range(10)]
+    assert mock_get.call_count == 10
+
+def test_iter_saved_track_ids_paginates(mock_sp):
+    pages = {
+        0: {'items': [{'track': {'id': 't1'}}], 'total': 120},
+        50: {'items': [{'track': {'id': 't2'}}], 'total': 120},
+        100: {'items': [{'track': {'id': 't3'}}, {'track': {'id': 't1'}}], 'total': 120}
+    }
+    mock_sp.current_user_saved_tracks.side_effect = lambda limit, offset: pages[offset]
+
+    assert list(new_releases.iter_saved_track_ids(mock_sp)) == ['t1', 't2', 't3', 't1']
+    mock_sp.next.assert_not_called()
 
 def test_create_or_get_playlist_exists(mock_sp, mock_logger):
     mock_sp.current_user.return_value = {'id': 'user_id'}
-    mock_sp.current_user_playlists.return_value = {
-        'items': [{'name': 'The News', 'id': 'playlist_id'}]
-    }
+    mock_sp.current_user_playlists.side_effect = lambda limit, offset: {
+        0: {'items': [{'name': 'Other', 'id': 'other_id'}], 'total': 51},
+        50: {'items': [{'name': 'The News', 'id': 'playlist_id'}], 'total': 51}
+    }[offset]
 
     pid = new_releases.create_or_get_playlist(mock_sp, 'The News', mock_logger)
     assert pid == 'playlist_id'
     mock_sp.user_playlist_create.assert_not_called()
+    assert new_releases.load_json_cache('playlists_user_id.json') == {
+        'Other': 'other_id', 'The News': 'playlist_id'
+    }
+
+def test_create_or_get_playlist_cached(mock_sp, mock_logger):
+    mock_sp.current_user.return_value = {'id': 'user_id'}
+    mock_sp.playlist.return_value = {'id': 'playlist_id', 'name': 'The News'}
+    mock_sp.playlist_is_following.return_value = [True]
+    new_releases.save_json_cache('playlists_user_id.json', {'The News': 'playlist_id'})
+
+    pid = new_releases.create_or_get_playlist(mock_sp, 'The News', mock_logger)
+    assert pid == 'playlist_id'
+    mock_sp.playlist.assert_called_once_with('playlist_id', fields='id,name')
+    mock_sp.playlist_is_following.assert_called_once_with('playlist_id', ['user_id'])
+    mock_sp.current_user_playlists.assert_not_called()
+
+def test_create_or_get_playlist_cached_but_deleted(mock_sp, mock_logger):
+    mock_sp.current_user.return_value = {'id': 'user_id'}
+    mock_sp.playlist.return_value = {'id': 'playlist_id', 'name': 'The News'}
+    mock_sp.playlist_is_following.return_value = [False]
+    mock_sp.current_user_playlists.return_value = {'items': [], 'total': 0}
+    mock_sp.user_playlist_create.return_value = {'id': 'new_id'}
+    new_releases.save_json_cache('playlists_user_id.json', {'The News': 'playlist_id'})
+
+    # A playlist the user deleted is still served by Spotify, but must be recreated
+    pid = new_releases.create_or_get_playlist(mock_sp, 'The News', mock_logger)
+    assert pid == 'new_id'
+    assert new_releases.load_json_cache('playlists_user_id.json') == {'The News': 'new_id'}
+
+def test_create_or_get_playlist_stale_cache(mock_sp, mock_logger):
+    mock_sp.current_user.return_value = {'id': 'user_id'}
+    mock_sp.playlist.side_effect = new_releases.spotipy.SpotifyException(404, -1, 'Not found')
+    mock_sp.current_user_playlists.return_value = {
+        'items': [{'name': 'The News', 'id': 'new_playlist_id'}],
+        'total': 1
+    }
+    new_releases.save_json_cache('playlists_user_id.json', {'The News': 'old_playlist_id'})
+
+    pid = new_releases.create_or_get_playlist(mock_sp, 'The News', mock_logger)
+    assert pid == 'new_playlist_id'
+    assert new_releases.load_json_cache('playlists_user_id.json') == {'The News': 'new_playlist_id'}
 
 def test_create_or_get_playlist_new(mock_sp, mock_logger):
     mock_sp.current_user.return_value = {'id': 'user_id'}
-    mock_sp.current_user_playlists.return_value = {'items': []}
+    mock_sp.current_user_playlists.return_value = {'items': [], 'total': 0}
     mock_sp.user_playlist_create.return_value = {'id': 'new_id'}
 
     pid = new_releases.create_or_get_playlist(mock_sp, 'The News', mock_logger)
@@ -89,15 +248,27 @@ def test_create_or_get_playlist_new(mock_sp, mock_logger):
         'user_id', 'The News', public=False, description='New releases from artists I follow'
     )
 
+def test_requests_are_paced(mock_sp, mock_logger):
+    mock_sp.current_user.return_value = {'id': 'user_id'}
+    mock_sp.current_user_playlists.return_value = {'items': [], 'total': 0}
+    mock_sp.user_playlist_create.return_value = {'id': 'new_id'}
+
+    with patch('spotify_client.rate_limiter') as mock_limiter:
+        new_releases.create_or_get_playlist(mock_sp, 'The News', mock_logger)
+
+    # current_user, current_user_playlists and user_playlist_create each wait their turn
+    assert mock_limiter.wait.call_count == 3
+
 def test_get_playlist_tracks(mock_sp, mock_logger):
     mock_sp.playlist_tracks.return_value = {
         'items': [{'track': {'id': 't1'}}, {'track': {'id': 't2'}}],
-        'next': None
+        'total': 2
     }
     track_ids = new_releases.get_playlist_tracks(mock_sp, 'pid', mock_logger)
     assert 't1' in track_ids
     assert 't2' in track_ids
     assert len(track_ids) == 2
+    mock_sp.playlist_tracks.assert_called_once_with('pid', fields='total,items(track(id))', limit=100, offset=0)
 
 def test_get_playlist_tracks_empty(mock_sp, mock_logger):
     mock_sp.playlist_tracks.side_effect = Exception("API Error")
@@ -105,22 +276,45 @@ def test_get_playlist_tracks_empty(mock_sp, mock_logger):
     assert len(track_ids) == 0
 
 def test_get_all_library_tracks(mock_sp, mock_logger):
-    with patch('new_releases.get_saved_tracks') as mock_saved, \
-         patch('new_releases.get_playlist_tracks') as mock_playlist:
-        mock_saved.return_value = {'t1'}
-        mock_playlist.return_value = {'t2'}
+    with patch('new_releases.iter_saved_track_ids') as mock_saved, \
+         patch('new_releases.iter_playlist_track_ids') as mock_playlist:
+        mock_saved.return_value = iter(['t1'])
+        mock_playlist.side_effect = [iter(['t2']), iter(['t1'])]
 
-        all_tracks = new_releases.get_all_library_tracks(mock_sp, 'p1,p2', mock_logger)
-        assert all_tracks == {'t1', 't2'}
+        all_tracks = new_releases.get_all_library_tracks(mock_sp, ('p1', 'p2'), mock_logger)
+        assert 't1' in all_tracks
+        assert 't2' in all_tracks
+        assert 't3' not in all_tracks
+        assert len(all_tracks) == 2
         assert mock_playlist.call_count == 2
 
-def test_get_album_tracks(mock_sp):
-    mock_sp.album_tracks.return_value = {
-        'items': [{'id': 't1'}, {'id': 't2'}],
-        'next': None
-    }
-    track_ids = new_releases.get_album_tracks(mock_sp, 'aid')
-    assert track_ids == ['t1', 't2']
+def test_get_albums_tracks(mock_sp):
+    album_ids = [f'aid{i}' for i in range(21)]
+    mock_sp.albums.side_effect = lambda ids: {'albums': [
+        {'id': aid, 'tracks': {'items': [{'id': f'{aid}_t1'}], 'next': None}} for aid in ids
+    ]}
+
+    result = new_releases.get_albums_tracks(mock_sp, album_ids)
+    assert result == {aid: [f'{aid}_t1'] for aid in album_ids}
+    assert mock_sp.albums.call_count == 2
+    assert len(mock_sp.albums.call_args_list[0].args[0]) == 20
+
+    # Cached albums are not requested again
+    mock_sp.albums.reset_mock()
+    assert new_releases.get_albums_tracks(mock_sp, album_ids) == result
+    mock_sp.albums.assert_not_called()
+
+def test_get_albums_tracks_long_album(mock_sp):
+    mock_sp.albums.return_value = {'albums': [
+        {'id': 'aid', 'tracks': {'items': [{'id': 't1'}], 'next': 'url'}},
+        None
+    ]}
+    mock_sp.next.return_value = {'items': [{'id': 't2'}], 'next': None}
+
+    result = new_releases.get_albums_tracks(mock_sp, ['aid', 'missing'])
+
+    assert result == {'aid': ['t1', 't2']}
+    mock_sp.next.assert_called_once_with({'items': [{'id': 't1'}], 'next': 'url'})
 
 def test_main(mock_sp, mock_logger):
     with patch('new_releases.setup_logging', return_value=mock_logger), \
@@ -130,7 +324,7 @@ def test_main(mock_sp, mock_logger):
          patch('new_releases.create_or_get_playlist', return_value='pid'), \
          patch('new_releases.get_playlist_tracks', return_value=set()), \
          patch('new_releases.get_artist_new_releases', return_value=[{'id': 'alb_id', 'name': 'Alb', 'release_date': '2026-01-28'}]), \
-         patch('new_releases.get_album_tracks', return_value=['t1']):
+         patch('new_releases.get_albums_tracks', return_value={'alb_id': ['t1']}):
 
         new_releases.main()
         mock_sp.playlist_add_items.assert_called()
@@ -144,7 +338,7 @@ def test_main_excludes_target_playlist_tracks(mock_sp, mock_logger):
          patch('new_releases.create_or_get_playlist', return_value='pid'), \
          patch('new_releases.get_playlist_tracks', return_value={'t1'}), \
          patch('new_releases.get_artist_new_releases', return_value=[{'id': 'alb_id', 'name': 'Alb', 'release_date': '2026-01-28'}]), \
-         patch('new_releases.get_album_tracks', return_value=['t1', 't2']):
+         patch('new_releases.get_albums_tracks', return_value={'alb_id': ['t1', 't2']}):
 
         new_releases.main()
 
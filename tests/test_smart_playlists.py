@@ -1,8 +1,11 @@
 import pytest
 import pylast
+import spotipy
 import time
-from unittest.mock import MagicMock, patch
+import threading
+from unittest.mock import MagicMock, patch, call
 from datetime import datetime, timedelta
+from xml.dom import minidom
 import smart_playlists
 
 @pytest.fixture(autouse=True)
@@ -10,55 +13,236 @@ def mock_sleep():
     with patch('time.sleep', return_value=None):
         yield
 
+def _track(uri, name='N', artist='A', **fields):
+    return smart_playlists.Track(uri, name, artist, smart_playlists._track_key(artist, name), **fields)
+
+@pytest.fixture(autouse=True)
+def rate_limiter():
+    with patch('spotify_client.rate_limiter') as mock_limiter:
+        yield mock_limiter
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path):
+    with patch('spotify_client.CACHE_DIR', tmp_path):
+        yield tmp_path
+
 @pytest.fixture
 def mock_spotify():
+    smart_playlists._get_user_playlists.cache_clear()
+    smart_playlists._get_user_playlist_ids.cache_clear()
+    smart_playlists._get_current_user_id.cache_clear()
     with patch('smart_playlists.sp') as mock_sp:
+        mock_sp.playlist.return_value = {}
+        mock_sp.current_user_playlists.return_value = {'items': [], 'total': 0}
         yield mock_sp
 
 @pytest.fixture
 def mock_lastfm():
+    smart_playlists._get_lastfm_user.cache_clear()
+    smart_playlists._fetch_lastfm_track_playcount.cache_clear()
     with patch('smart_playlists.network') as mock_network:
+        mock_network.get_user.return_value._get_params.return_value = {'user': 'test_user'}
         yield mock_network
 
+def _top_tracks_pages(tracks):
+    """Serve (artist, title, playcount) tuples as pages of a user.getTopTracks response"""
+    def request(method, cacheable, params):
+        limit, page = params['limit'], params['page']
+        total_pages = max(1, -(-len(tracks) // limit))
+        nodes = ''.join(
+            f'<track><name>{title}</name><playcount>{playcount}</playcount><artist><name>{artist}</name></artist></track>'
+            for artist, title, playcount in tracks[(page - 1) * limit:page * limit]
+        )
+        return minidom.parseString(f'<lfm status="ok"><toptracks totalPages="{total_pages}">{nodes}</toptracks></lfm>')
+    return request
+
 def test_format_elapsed_time():
     assert smart_playlists.format_elapsed_time(5) == "5s"
     assert smart_playlists.format_elapsed_time(65) == "1m 5s"
     assert smart_playlists.format_elapsed_time(3665) == "1h 1m 5s"
 
-def test_create_track_dict():
+def test_track_key():
+    key = smart_playlists._track_key('Test Artist', 'Test Track')
+    assert isinstance(key, int)
+    assert key == smart_playlists._track_key('test artist', 'TEST TRACK')
+    assert key != smart_playlists._track_key('Test Artist', 'Other Track')
+
+def test_create_track():
     track = {
         'uri': 'spotify:track:123',
         'name': 'Test Track',
         'artists': [{'name': 'Test Artist'}]
     }
     added_at = '2026-01-28T13:00:00Z'
-    result = smart_playlists._create_track_dict(track, added_at)
-    assert result['uri'] == 'spotify:track:123'
-    assert result['added_at'] == datetime(2026, 1, 28, 13, 0, 0)
-    assert result['key'] == 'test artist|||test track'
-
-    assert smart_playlists._create_track_dict(None) is None
-    assert smart_playlists._create_track_dict({}) is None
+    result = smart_playlists._create_track(track, added_at)
+    assert result.uri == 'spotify:track:123'
+    assert result.added_at == datetime(2026, 1, 28, 13, 0, 0)
+    assert result.key == smart_playlists._track_key('test artist', 'test track')
+
+    assert smart_playlists._create_track(None) is None
+    assert smart_playlists._create_track({}) is None
+
+def test_create_track_missing_fields():
+    result = smart_playlists._create_track({'uri': 'spotify:track:123', 'artists': []})
+    assert result.artist == 'Unknown'
+    assert result.name == 'Unknown'
+    assert result.added_at is None
+    assert smart_playlists._create_track({'uri': None}) is None
+
+def test_parse_spotify_timestamp():
+    timestamp = '2026-01-28T13:05:09Z'
+    assert smart_playlists._parse_spotify_timestamp(timestamp) == datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ')
+
+def test_parse_spotify_timestamp_fallback():
+    # Other ISO 8601 layouts fall back to the general parser, normalised to naive UTC
+    assert smart_playlists._parse_spotify_timestamp('2026-01-28') == datetime(2026, 1, 28)
+    assert smart_playlists._parse_spotify_timestamp('2026-01-28T15:00:05+02:00') == datetime(2026, 1, 28, 13, 0, 5)
+    with pytest.raises(ValueError):
+        smart_playlists._parse_spotify_timestamp('not a date')
 
 def test_get_all_playlist_tracks(mock_spotify):
     mock_spotify.playlist_tracks.side_effect = [
-        {'items': [{'track': {'uri': '1'}}], 'next': 'url'},
-        {'items': [{'track': {'uri': '2'}}], 'next': None}
+        {'items': [{'track': {'uri': '1'}}], 'total': 150},
+        {'items': [{'track': {'uri': '2'}}], 'total': 150}
     ]
     tracks = smart_playlists.get_all_playlist_tracks('playlist_id')
     assert len(tracks) == 2
     assert tracks[0]['track']['uri'] == '1'
     assert tracks[1]['track']['uri'] == '2'
+    mock_spotify.playlist_tracks.assert_called_with(
+        'playlist_id', fields=smart_playlists.PLAYLIST_TRACK_FIELDS, offset=100, limit=100
+    )
+
+def test_get_all_playlist_tracks_concurrent_pages(mock_spotify):
+    def fetch(playlist_id, fields, offset, limit):
+        return {'items': [{'track': {'uri': str(offset)}}], 'total': 450}
+    mock_spotify.playlist_tracks.side_effect = fetch
+
+    tracks = smart_playlists.get_all_playlist_tracks('playlist_id')
+    # Pages come back in offset order even though they are fetched concurrently
+    assert [t['track']['uri'] for t in tracks] == ['0', '100', '200', '300', '400']
+
+def test_get_all_playlist_tracks_retries_rate_limit(mock_spotify):
+    rate_limit_error = spotipy.SpotifyException(429, -1, 'rate limit', headers={'Retry-After': '7'})
+    mock_spotify.playlist_tracks.side_effect = [
+        rate_limit_error,
+        {'items': [{'track': {'uri': '1'}}], 'total': 1}
+    ]
+
+    with patch('smart_playlists.time.sleep') as mock_sleep:
+        tracks = smart_playlists.get_all_playlist_tracks('playlist_id')
+
+    assert [t['track']['uri'] for t in tracks] == ['1']
+    mock_sleep.assert_called_once_with(7)
+
+def test_add_playlist_items_retries_rate_limit(mock_spotify):
+    rate_limit_error = spotipy.SpotifyException(429, -1, 'rate limit', headers={'Retry-After': '2'})
+    mock_spotify.playlist_add_items.side_effect = [None, rate_limit_error, None]
+
+    with patch('smart_playlists.time.sleep') as mock_sleep:
+        smart_playlists._add_playlist_items('p1', [f't{i}' for i in range(150)])
+
+    # Only the rate-limited batch is sent again
+    assert [c.args[1][0] for c in mock_spotify.playlist_add_items.call_args_list] == ['t0', 't100', 't100']
+    mock_sleep.assert_called_once_with(2)
+
+def test_get_all_playlist_tracks_cached_by_snapshot(mock_spotify):
+    mock_spotify.playlist.return_value = {'snapshot_id': 'snap1'}
+    mock_spotify.playlist_tracks.return_value = {'items': [{'track': {'uri': '1'}}], 'total': 1}
+
+    assert smart_playlists.get_all_playlist_tracks('p1') == [{'track': {'uri': '1'}}]
+    assert smart_playlists.get_all_playlist_tracks('p1') == [{'track': {'uri': '1'}}]
+    mock_spotify.playlist.assert_called_with('p1', fields='snapshot_id')
+    assert mock_spotify.playlist_tracks.call_count == 1
+
+    # A new snapshot means the contents changed
+    mock_spotify.playlist.return_value = {'snapshot_id': 'snap2'}
+    smart_playlists.get_all_playlist_tracks('p1')
+    assert mock_spotify.playlist_tracks.call_count == 2
+
+def test_get_all_playlist_tracks_given_snapshot(mock_spotify):
+    mock_spotify.playlist_tracks.return_value = {'items': [{'track': {'uri': '1'}}], 'total': 1}
+    smart_playlists.get_all_playlist_tracks('p1', 'snap1')
+    assert smart_playlists.get_all_playlist_tracks('p1', 'snap1') == [{'track': {'uri': '1'}}]
 
-def test_get_liked_songs(mock_spotify):
+    # The caller's snapshot is trusted, so no extra lookup is made
+    mock_spotify.playlist.assert_not_called()
+    assert mock_spotify.playlist_tracks.call_count == 1
+
+def test_spotify_requests_are_paced(mock_spotify, rate_limiter):
+    mock_spotify.playlist_tracks.side_effect = _playlist_pages([f't{i}' for i in range(250)])
+    smart_playlists.get_all_playlist_tracks('p1', 'snap')
+    smart_playlists.spotify_call(mock_spotify.current_user)
+
+    # One wait per page plus one for the single call
+    assert rate_limiter.wait.call_count == 4
+
+def test_get_all_playlist_tracks_error(mock_spotify):
+    mock_spotify.playlist_tracks.side_effect = Exception("API Error")
+    assert smart_playlists.get_all_playlist_tracks('playlist_id') == []
+
+def test_iter_liked_songs(mock_spotify):
     mock_spotify.current_user_saved_tracks.side_effect = [
-        {'items': [{'track': {'uri': '1'}, 'added_at': '2026-01-28T13:00:00Z'}], 'next': None},
-        {'items': [], 'next': None}
+        {'items': [{'track': {'uri': '1'}, 'added_at': '2026-01-28T13:00:00Z'}], 'total': 1}
     ]
-    tracks = smart_playlists.get_liked_songs()
+    tracks = list(smart_playlists._iter_liked_songs())
     assert len(tracks) == 1
     assert tracks[0]['track']['uri'] == '1'
 
+def test_iter_liked_songs_paginates(mock_spotify):
+    def fetch(limit, offset):
+        return {
+            'items': [{'track': {'uri': str(offset)}, 'added_at': '2026-01-28T13:00:00Z'}],
+            'total': 120
+        }
+    mock_spotify.current_user_saved_tracks.side_effect = fetch
+
+    tracks = list(smart_playlists._iter_liked_songs())
+    assert [t['track']['uri'] for t in tracks] == ['0', '50', '100']
+    # Stops at the total instead of requesting an extra empty page
+    assert mock_spotify.current_user_saved_tracks.call_count == 3
+
+def _saved_tracks_pages(uris):
+    def fetch(limit, offset):
+        return {
+            'items': [
+                {'track': {'uri': uri, 'name': uri, 'artists': [{'name': 'A'}], 'popularity': 50},
+                 'added_at': '2026-01-28T13:00:00Z'}
+                for uri in uris[offset:offset + limit]
+            ],
+            'total': len(uris)
+        }
+    return fetch
+
+def test_iter_liked_songs_fetches_only_new_likes(mock_spotify):
+    liked = [f't{i}' for i in range(120)]
+    mock_spotify.current_user_saved_tracks.side_effect = _saved_tracks_pages(liked)
+    list(smart_playlists._iter_liked_songs())
+    assert mock_spotify.current_user_saved_tracks.call_count == 3
+
+    # Two new likes at the top: only the first page is needed
+    mock_spotify.current_user_saved_tracks.reset_mock()
+    mock_spotify.current_user_saved_tracks.side_effect = _saved_tracks_pages(['new1', 'new2'] + liked)
+    tracks = list(smart_playlists._iter_liked_songs())
+
+    assert [t['track']['uri'] for t in tracks] == ['new1', 'new2'] + liked
+    assert mock_spotify.current_user_saved_tracks.call_count == 1
+    # Only the fields the library uses are kept
+    assert tracks[0]['track'] == {'uri': 'new1', 'name': 'new1', 'artists': [{'name': 'A'}]}
+
+def test_iter_liked_songs_refetches_after_unlike(mock_spotify):
+    liked = [f't{i}' for i in range(120)]
+    mock_spotify.current_user_saved_tracks.side_effect = _saved_tracks_pages(liked)
+    list(smart_playlists._iter_liked_songs())
+
+    # An unliked track means the snapshot can't be trusted
+    mock_spotify.current_user_saved_tracks.reset_mock()
+    mock_spotify.current_user_saved_tracks.side_effect = _saved_tracks_pages(liked[:50] + liked[51:])
+    tracks = list(smart_playlists._iter_liked_songs())
+
+    assert [t['track']['uri'] for t in tracks] == liked[:50] + liked[51:]
+    assert mock_spotify.current_user_saved_tracks.call_count == 4
+
 def test_get_lastfm_track_playcount(mock_lastfm):
     mock_track = MagicMock()
     mock_track.get_userplaycount.return_value = 10
@@ -66,24 +250,55 @@ def test_get_lastfm_track_playcount(mock_lastfm):
 
     count = smart_playlists.get_lastfm_track_playcount('Artist', 'Track')
     assert count == 10
+    # Repeat lookups are served from memory
+    assert smart_playlists.get_lastfm_track_playcount('Artist', 'Track') == 10
+    mock_lastfm.get_track.assert_called_once_with('Artist', 'Track')
 
     mock_track.get_userplaycount.return_value = None
-    assert smart_playlists.get_lastfm_track_playcount('Artist', 'Track') == 0
+    assert smart_playlists.get_lastfm_track_playcount('Artist', 'Track 2') == 0
+
+    mock_lastfm.get_track.side_effect = pylast.WSError("network", "6", "Track not found")
+    assert smart_playlists.get_lastfm_track_playcount('Artist', 'Track 3') == 0
+
+def test_get_lastfm_track_playcount_errors_are_not_cached(mock_lastfm):
+    mock_track = MagicMock()
+    mock_track.get_userplaycount.return_value = 10
+    mock_lastfm.get_track.side_effect = [
+        pylast.WSError("network", "29", "rate limit"), mock_track,
+        Exception("Error"), mock_track
+    ]
 
-    mock_lastfm.get_track.side_effect = Exception("Error")
-    assert smart_playlists.get_lastfm_track_playcount('Artist', 'Track') == 0
+    # A rate limit is retried rather than read as zero plays
+    assert smart_playlists.get_lastfm_track_playcount('Artist', 'Track') == 10
+
+    # Any other failure is reported as unknown, and the next lookup tries again
+    assert smart_playlists.get_lastfm_track_playcount('Artist', 'Track 2') is None
+    assert smart_playlists.get_lastfm_track_playcount('Artist', 'Track 2') == 10
+
+
+
+def test_update_library_with_track_item_keeps_oldest_date():
+    track = {'uri': 't1', 'name': 'N', 'artists': [{'name': 'A'}]}
+    all_tracks = {}
+    smart_playlists._update_library_with_track_item(all_tracks, {'track': track, 'added_at': '2026-01-28T13:00:00Z'})
 
+    with patch('smart_playlists._create_track') as mock_create:
+        smart_playlists._update_library_with_track_item(all_tracks, {'track': track, 'added_at': '2026-01-30T13:00:00Z'})
+        smart_playlists._update_library_with_track_item(all_tracks, {'track': track, 'added_at': '2026-01-20T13:00:00Z'})
+        smart_playlists._update_library_with_track_item(all_tracks, {'track': track})
+    # Duplicates are merged in place without building another Track
+    mock_create.assert_not_called()
 
+    assert all_tracks['t1'].added_at == datetime(2026, 1, 20, 13, 0, 0)
 
 def test_add_liked_songs_to_library(mock_spotify):
     mock_spotify.current_user_saved_tracks.side_effect = [
-        {'items': [{'track': {'uri': '1', 'name': 'N1', 'artists': [{'name': 'A1'}]}, 'added_at': '2026-01-28T13:00:00Z'}], 'next': None},
-        {'items': [], 'next': None}
+        {'items': [{'track': {'uri': '1', 'name': 'N1', 'artists': [{'name': 'A1'}]}, 'added_at': '2026-01-28T13:00:00Z'}], 'total': 1}
     ]
     all_tracks = {}
     smart_playlists._add_liked_songs_to_library(all_tracks)
     assert '1' in all_tracks
-    assert all_tracks['1']['name'] == 'N1'
+    assert all_tracks['1'].name == 'N1'
 
 def test_update_recent_tracks_playlist(mock_spotify):
     with patch('smart_playlists.get_all_spotify_library_tracks') as mock_library, \
@@ -91,9 +306,9 @@ def test_update_recent_tracks_playlist(mock_spotify):
 
         now = datetime.now()
         mock_library.return_value = {
-            't1': {'uri': 't1', 'added_at': now - timedelta(days=5)},
-            't2': {'uri': 't2', 'added_at': now - timedelta(days=40)}, # Old
-            't3': {'uri': 't3', 'added_at': now - timedelta(days=2)}
+            't1': _track('t1', added_at=now - timedelta(days=5)),
+            't2': _track('t2', added_at=now - timedelta(days=40)), # Old
+            't3': _track('t3', added_at=now - timedelta(days=2))
         }
 
         smart_playlists.update_recent_tracks_playlist(mock_library.return_value, 'Target')
@@ -101,47 +316,123 @@ def test_update_recent_tracks_playlist(mock_spotify):
         # Should only include t3 and t1, sorted t3 then t1
         mock_create_update.assert_called_with('Target', ['t3', 't1'])
 
+def test_update_recent_tracks_playlist_caps_size():
+    now = datetime.now()
+    library = {
+        f't{i}': _track(f't{i}', added_at=now - timedelta(minutes=i)) for i in range(5)
+    }
+    with patch('smart_playlists.MAX_PLAYLIST_SIZE', 3), \
+         patch('smart_playlists.create_or_update_playlist') as mock_create_update:
+        smart_playlists.update_recent_tracks_playlist(library, 'Target')
+
+    mock_create_update.assert_called_with('Target', ['t0', 't1', 't2'])
+
 def test_match_spotify_with_lastfm(mock_lastfm):
     spotify_tracks = {
-        'uri1': {'name': 'Name1', 'artist': 'Artist1'},
-        'uri2': {'name': 'Name2', 'artist': 'Artist2'}
+        'uri1': _track('uri1', 'Name1', 'Artist1'),
+        'uri2': _track('uri2', 'Name2', 'Artist2')
     }
 
     with patch('smart_playlists.get_all_lastfm_playcounts') as mock_bulk:
         mock_bulk.return_value = {
-            'artist1|||name1': 10,
-            'artist2|||name2': 5
+            smart_playlists._track_key('Artist1', 'Name1'): 10,
+            smart_playlists._track_key('Artist2', 'Name2'): 5
         }
 
         result = smart_playlists.match_spotify_with_lastfm(spotify_tracks)
         assert len(result) == 2
-        assert result[0]['playcount'] == 10
-        assert result[1]['playcount'] == 5
+        assert result[0].playcount == 10
+        assert result[1].playcount == 5
 
 def test_get_all_lastfm_playcounts(mock_lastfm):
-    mock_user = MagicMock()
-    mock_lastfm.get_user.return_value = mock_user
+    mock_user = mock_lastfm.get_user.return_value
+    tracks = [("Artist1", "Track1", 10), ("Artist2", "Track2", 5), ("Artist3", "Track3", 1)]
+    mock_user._request.side_effect = _top_tracks_pages(tracks)
 
-    # Mock tracks
-    track1 = MagicMock()
-    track1.item.artist.name = "Artist1"
-    track1.item.title = "Track1"
-    track1.weight = "10"
+    with patch('smart_playlists.LASTFM_USERNAME', 'test_user'), \
+         patch('smart_playlists.LASTFM_PAGE_SIZE', 2):
+        result = smart_playlists.get_all_lastfm_playcounts()
+
+    assert result == {smart_playlists._track_key(artist, title): count for artist, title, count in tracks}
+    # One request per page, each asking for a full page
+    pages = sorted(c.args[2]['page'] for c in mock_user._request.call_args_list)
+    assert pages == [1, 2]
+    assert mock_user._request.call_args.args[0] == 'user.getTopTracks'
+
+def test_request_top_tracks_page_with_real_pylast_user():
+    # A real pylast User, with only the HTTP response faked, so a pylast release
+    # that changes the private helpers the adapter uses fails here
+    user = pylast.LastFMNetwork(api_key='key').get_user('test_user')
+    body = (
+        '<lfm status="ok"><toptracks user="test_user" page="2" totalPages="3">'
+        '<track rank="1001"><name>Track1</name><playcount>1234</playcount>'
+        '<artist><name>Artist1</name></artist></track>'
+        '</toptracks></lfm>'
+    )
+    response = pylast.httpx.Response(200, content=body.encode())
+
+    with patch.object(pylast.httpx.Client, 'post', return_value=response) as mock_post:
+        result = smart_playlists._request_top_tracks_page(user, 2)
+
+    assert result == (3, [('Artist1', 'Track1', 1234)])
+    sent = mock_post.call_args.kwargs['data']
+    assert sent['method'] == 'user.getTopTracks'
+    assert sent['user'] == 'test_user'
+    assert (sent['period'], sent['limit'], sent['page']) == ('overall', str(smart_playlists.LASTFM_PAGE_SIZE), '2')
+
+def test_get_all_lastfm_playcounts_uses_fresh_cache(mock_lastfm):
+    top_tracks = mock_lastfm.get_user.return_value._request
+    top_tracks.side_effect = _top_tracks_pages([("Artist1", "Track1", 10)])
+
+    first = smart_playlists.get_all_lastfm_playcounts()
+    second = smart_playlists.get_all_lastfm_playcounts()
+    assert first == second == {smart_playlists._track_key('Artist1', 'Track1'): 10}
+    assert top_tracks.call_count == 1
+
+    # A week-old cache is rebuilt from scratch
+    with patch('smart_playlists.time.time', return_value=time.time() + smart_playlists.LASTFM_FULL_REFRESH_AGE):
+        smart_playlists.get_all_lastfm_playcounts()
+    assert top_tracks.call_count == 2
+    # The user object is built only once
+    mock_lastfm.get_user.assert_called_once()
+
+def test_get_all_lastfm_playcounts_keeps_cache_when_refresh_fails(mock_lastfm):
+    user = mock_lastfm.get_user.return_value
+    user._request.side_effect = _top_tracks_pages([("Artist1", "Track1", 10)])
+    smart_playlists.get_all_lastfm_playcounts()
+
+    # A full refresh that fails part way keeps the previous playcounts
+    user._request.side_effect = Exception("Error")
+    with patch('smart_playlists.time.time', return_value=time.time() + smart_playlists.LASTFM_FULL_REFRESH_AGE):
+        result = smart_playlists.get_all_lastfm_playcounts()
+
+    assert result == {smart_playlists._track_key('Artist1', 'Track1'): 10}
 
-    track2 = MagicMock()
-    track2.item.artist.name = "Artist2"
-    track2.item.title = "Track2"
-    track2.weight = "5"
+def test_get_all_lastfm_playcounts_adds_recent_scrobbles(mock_lastfm):
+    user = mock_lastfm.get_user.return_value
+    user._request.side_effect = _top_tracks_pages([("Artist1", "Track1", 10)])
+    smart_playlists.get_all_lastfm_playcounts()
 
-    # get_top_tracks returns an iterable list in our mock
-    mock_user.get_top_tracks.return_value = [track1, track2]
+    scrobbles = []
+    for artist, title in [("Artist1", "Track1"), ("Artist2", "Track2"), ("Artist1", "Track1")]:
+        played = MagicMock()
+        played.track.artist.name = artist
+        played.track.title = title
+        scrobbles.append(played)
+    user.get_recent_tracks.return_value = scrobbles
 
-    with patch('smart_playlists.LASTFM_USERNAME', 'test_user'):
+    later = time.time() + smart_playlists.LASTFM_CACHE_TTL
+    with patch('smart_playlists.time.time', return_value=later):
         result = smart_playlists.get_all_lastfm_playcounts()
 
-    assert len(result) == 2
-    assert result['artist1|||track1'] == 10
-    assert result['artist2|||track2'] == 5
+    # Only the scrobbles since the last fetch are requested and counted
+    assert user._request.call_count == 1
+    assert user.get_recent_tracks.call_args.kwargs['time_from'] < later
+    assert result == {
+        smart_playlists._track_key('Artist1', 'Track1'): 12,
+        smart_playlists._track_key('Artist2', 'Track2'): 1
+    }
+    assert smart_playlists.load_json_cache(f'lastfm_playcounts_{smart_playlists.LASTFM_USERNAME}.json')['fetched_at'] == later
 
 def test_retry_on_rate_limit():
     mock_func = MagicMock()
@@ -181,29 +472,160 @@ def test_get_all_lastfm_playcounts_rate_limit(mock_lastfm):
 
     # Force a rate limit error
     rate_limit_error = pylast.WSError("network", "29", "rate limit")
-    mock_user.get_top_tracks.side_effect = rate_limit_error
+    mock_user._request.side_effect = rate_limit_error
 
     with patch('smart_playlists.LASTFM_USERNAME', 'test_user'), \
          patch('smart_playlists.time.sleep'):
         result = smart_playlists.get_all_lastfm_playcounts()
 
     assert result == {}
-    assert mock_user.get_top_tracks.call_count == 1
+    # The first page plus three retries
+    assert mock_user._request.call_count == 4
+
+def test_get_all_lastfm_playcounts_retries_rate_limit(mock_lastfm):
+    tracks = [("Artist1", "Track1", 10), ("Artist2", "Track2", 5), ("Artist3", "Track3", 1)]
+    serve_page = _top_tracks_pages(tracks)
+    throttled = []
+
+    def request(method, cacheable, params):
+        if params['page'] == 2 and not throttled:
+            throttled.append(params['page'])
+            raise pylast.WSError("network", "29", "rate limit")
+        return serve_page(method, cacheable, params)
+
+    user = mock_lastfm.get_user.return_value
+    user._request.side_effect = request
+
+    with patch('smart_playlists.LASTFM_PAGE_SIZE', 1), \
+         patch('smart_playlists.time.sleep') as mock_sleep:
+        result = smart_playlists.get_all_lastfm_playcounts()
+
+    assert result == {smart_playlists._track_key(artist, title): count for artist, title, count in tracks}
+    # Only the throttled page is fetched again
+    assert sorted(c.args[2]['page'] for c in user._request.call_args_list) == [1, 2, 2, 3]
+    mock_sleep.assert_called_once_with(1)
+
+def _playlist_pages(uris):
+    def fetch(playlist_id, fields, offset, limit):
+        return {'items': [{'track': {'uri': uri}} for uri in uris[offset:offset + limit]], 'total': len(uris)}
+    return fetch
 
 def test_create_or_update_playlist_exists(mock_spotify):
-    mock_spotify.current_user_playlists.return_value = {'items': [{'name': 'P1', 'id': 'p1'}]}
+    mock_spotify.current_user_playlists.return_value = {'items': [{'name': 'P1', 'id': 'p1'}], 'total': 1}
+    kept = [f't{i}' for i in range(250)]
+    mock_spotify.playlist_tracks.side_effect = _playlist_pages(['old'] + kept)
+    smart_playlists.create_or_update_playlist('P1', ['new1', 'new2'] + kept + ['new3'])
+
+    # Only the difference is sent: remove old, insert new1/new2 at the top and append new3
+    mock_spotify.playlist_replace_items.assert_not_called()
+    mock_spotify.playlist_remove_all_occurrences_of_items.assert_called_once_with('p1', ['old'])
+    assert mock_spotify.playlist_add_items.call_args_list == [
+        call('p1', ['new1', 'new2'], position=0),
+        call('p1', ['new3'], position=252)
+    ]
+
+def test_create_or_update_playlist_small_change_replaces(mock_spotify):
+    mock_spotify.current_user_playlists.return_value = {'items': [{'name': 'P1', 'id': 'p1'}], 'total': 1}
+    mock_spotify.playlist_tracks.side_effect = _playlist_pages(['t0', 't2', 't4'])
+    smart_playlists.create_or_update_playlist('P1', ['t1', 't2', 't3'])
+
+    # Replacing takes fewer requests than the diff here
+    mock_spotify.playlist_replace_items.assert_called_once_with('p1', ['t1', 't2', 't3'])
+    mock_spotify.playlist_add_items.assert_not_called()
+
+def test_create_or_update_playlist_unchanged(mock_spotify):
+    mock_spotify.current_user_playlists.return_value = {'items': [{'name': 'P1', 'id': 'p1'}], 'total': 1}
+    mock_spotify.playlist_tracks.side_effect = _playlist_pages(['t1', 't2'])
+    smart_playlists.create_or_update_playlist('P1', ['t1', 't2'])
+
+    mock_spotify.playlist_replace_items.assert_not_called()
+    mock_spotify.playlist_remove_all_occurrences_of_items.assert_not_called()
+    mock_spotify.playlist_add_items.assert_not_called()
+
+def test_create_or_update_playlist_reordered(mock_spotify):
+    mock_spotify.current_user_playlists.return_value = {'items': [{'name': 'P1', 'id': 'p1'}], 'total': 1}
+    mock_spotify.playlist_tracks.side_effect = _playlist_pages(['t2', 't1'])
+    smart_playlists.create_or_update_playlist('P1', ['t1', 't2'])
+
+    # Order changed, so the playlist is replaced outright
+    mock_spotify.playlist_replace_items.assert_called_once_with('p1', ['t1', 't2'])
+    mock_spotify.playlist_add_items.assert_not_called()
+
+def test_create_or_update_playlist_read_failure_replaces(mock_spotify):
+    mock_spotify.current_user_playlists.return_value = {'items': [{'name': 'P1', 'id': 'p1'}], 'total': 1}
+    track_uris = [f't{i}' for i in range(150)]
+    serve_page = _playlist_pages(track_uris)
+
+    def fetch(playlist_id, fields, offset, limit):
+        if offset:
+            raise Exception("API Error")
+        return serve_page(playlist_id, fields, offset, limit)
+    mock_spotify.playlist_tracks.side_effect = fetch
+
+    smart_playlists.create_or_update_playlist('P1', track_uris)
+
+    # A partial read can't be diffed against, so nothing is appended on top of it
+    mock_spotify.playlist_replace_items.assert_called_once_with('p1', track_uris[:100])
+    mock_spotify.playlist_add_items.assert_called_once_with('p1', track_uris[100:])
+
+def test_create_or_update_playlist_replace_adds_remaining_batches(mock_spotify):
+    mock_spotify.current_user_playlists.return_value = {'items': [{'name': 'P1', 'id': 'p1'}], 'total': 1}
+    mock_spotify.playlist_tracks.side_effect = _playlist_pages(['old'])
+    track_uris = [f't{i}' for i in range(150)]
+    smart_playlists.create_or_update_playlist('P1', track_uris)
+
+    mock_spotify.playlist_replace_items.assert_called_once_with('p1', track_uris[:100])
+    mock_spotify.playlist_add_items.assert_called_once_with('p1', track_uris[100:])
+
+def test_create_or_update_playlist_duplicate_name_uses_first(mock_spotify):
+    mock_spotify.current_user_playlists.return_value = {
+        'items': [{'name': 'P1', 'id': 'p1'}, {'name': 'P1', 'id': 'p1-dupe'}], 'total': 2
+    }
+    mock_spotify.playlist_tracks.side_effect = _playlist_pages(['t1'])
     smart_playlists.create_or_update_playlist('P1', ['t1'])
-    mock_spotify.playlist_replace_items.assert_called_with('p1', [])
-    mock_spotify.playlist_add_items.assert_called_with('p1', ['t1'])
+
+    mock_spotify.playlist_tracks.assert_called_once()
+    assert mock_spotify.playlist_tracks.call_args.args[0] == 'p1'
 
 def test_create_or_update_playlist_new(mock_spotify):
-    mock_spotify.current_user_playlists.return_value = {'items': []}
+    mock_spotify.current_user_playlists.return_value = {'items': [], 'total': 0}
     mock_spotify.current_user.return_value = {'id': 'user_id'}
     mock_spotify.user_playlist_create.return_value = {'id': 'p1'}
     smart_playlists.create_or_update_playlist('P1', ['t1'])
     mock_spotify.user_playlist_create.assert_called_with('user_id', 'P1', public=True)
     mock_spotify.playlist_add_items.assert_called_with('p1', ['t1'])
 
+def test_create_or_update_playlist_lookup_paginates_once(mock_spotify):
+    playlists = [{'name': f'P{i}', 'id': f'p{i}'} for i in range(60)]
+    mock_spotify.current_user_playlists.side_effect = (
+        lambda limit, offset: {'items': playlists[offset:offset + limit], 'total': len(playlists)}
+    )
+    mock_spotify.playlist_tracks.side_effect = _playlist_pages(['t1'])
+    mock_spotify.current_user.return_value = {'id': 'user_id'}
+    mock_spotify.user_playlist_create.return_value = {'id': 'new'}
+
+    # P55 is past the first page of playlists
+    smart_playlists.create_or_update_playlist('P55', ['t1'])
+    smart_playlists.create_or_update_playlist('New', ['t1'])
+    smart_playlists.create_or_update_playlist('New', ['t1'])
+    smart_playlists.create_or_update_playlist('Another', ['t1'])
+
+    # The user id is also fetched only once
+    assert mock_spotify.user_playlist_create.call_args_list == [
+        call('user_id', 'New', public=True),
+        call('user_id', 'Another', public=True)
+    ]
+    mock_spotify.current_user.assert_called_once()
+    # Every lookup after the first is served from the same listing
+    assert mock_spotify.current_user_playlists.call_count == 2
+
+def test_format_track_list():
+    tracks = [
+        _track('t1', 'N1', 'A1', playcount=10),
+        _track('t2', 'N2', 'A2', playcount=5)
+    ]
+    assert smart_playlists._format_track_list(tracks) == "1. A1 - N1 (10 plays)\n2. A2 - N2 (5 plays)"
+
 def test_update_playcount_playlists(mock_spotify):
     with patch('smart_playlists.get_all_spotify_library_tracks') as mock_library, \
          patch('smart_playlists.match_spotify_with_lastfm') as mock_match, \
@@ -211,13 +633,29 @@ def test_update_playcount_playlists(mock_spotify):
 
         mock_library.return_value = {}
         mock_match.return_value = [
-            {'uri': 't1', 'artist': 'A', 'name': 'N', 'playcount': 100},
-            {'uri': 't2', 'artist': 'A2', 'name': 'N2', 'playcount': 10}
+            _track('t1', 'N', 'A', playcount=100),
+            _track('t2', 'N2', 'A2', playcount=10)
         ]
 
         smart_playlists.update_playcount_playlists(mock_library.return_value, 'Top', 'Bottom')
         assert mock_create_update.call_count == 2
 
+def test_update_playcount_playlists_top_and_bottom(mock_spotify):
+    tracks = [
+        _track(f'u{i}', f'N{i}', playcount=i % 40)
+        for i in range(120)
+    ]
+    with patch('smart_playlists.match_spotify_with_lastfm', return_value=tracks), \
+         patch('smart_playlists.create_or_update_playlist') as mock_create_update:
+        smart_playlists.update_playcount_playlists({}, 'Top', 'Bottom')
+
+    top_uris = mock_create_update.call_args_list[0].args[1]
+    bottom_uris = mock_create_update.call_args_list[1].args[1]
+    playcounts = {t.uri: t.playcount for t in tracks}
+    assert [playcounts[uri] for uri in top_uris] == sorted(playcounts.values(), reverse=True)[:25]
+    # Unplayed tracks are skipped, then the lowest counts fill the playlist
+    assert sorted(playcounts[uri] for uri in bottom_uris) == sorted(pc for pc in playcounts.values() if pc)[:25]
+
 
 
 def test_get_all_spotify_library_tracks(mock_spotify):
@@ -229,6 +667,24 @@ def test_get_all_spotify_library_tracks(mock_spotify):
         mock_liked.assert_called_once()
         mock_playlist.assert_called_once()
 
+def test_get_all_spotify_library_tracks_merges_liked_songs(mock_spotify):
+    def add_liked(all_tracks):
+        all_tracks['t1'] = _track('t1', added_at=datetime(2026, 1, 10))
+        all_tracks['t2'] = _track('t2', added_at=datetime(2026, 1, 10))
+        return all_tracks
+
+    def add_playlists(all_tracks, playlist_ids):
+        all_tracks['t1'] = _track('t1', added_at=datetime(2026, 1, 20))
+        all_tracks['t3'] = _track('t3', added_at=datetime(2026, 1, 5))
+
+    with patch('smart_playlists._add_liked_songs_to_library', side_effect=add_liked), \
+         patch('smart_playlists._add_playlist_tracks_to_library', side_effect=add_playlists):
+        result = smart_playlists.get_all_spotify_library_tracks(['ids'])
+
+    assert sorted(result) == ['t1', 't2', 't3']
+    # The oldest date wins across liked songs and playlists
+    assert result['t1'].added_at == datetime(2026, 1, 10)
+
 def test_add_playlist_tracks_to_library(mock_spotify):
     mock_spotify.playlist.return_value = {'name': 'P1'}
     with patch('smart_playlists.get_all_playlist_tracks') as mock_get:
@@ -236,3 +692,42 @@ def test_add_playlist_tracks_to_library(mock_spotify):
         all_tracks = {}
         smart_playlists._add_playlist_tracks_to_library(all_tracks, ['id'])
         assert 't1' in all_tracks
+    mock_spotify.playlist.assert_called_once_with('id', fields='name,snapshot_id')
+
+def test_add_playlist_tracks_to_library_skips_unparseable_playlist(mock_spotify):
+    mock_spotify.playlist.return_value = {'name': 'P'}
+    items = {
+        'bad': [{'track': {'uri': 't1', 'name': 'N', 'artists': [{'name': 'A'}]}, 'added_at': 'not a date'}],
+        'good': [{'track': {'uri': 't2', 'name': 'N', 'artists': [{'name': 'A'}]}, 'added_at': '2026-01-20T13:00:00Z'}],
+    }
+    with patch('smart_playlists.get_all_playlist_tracks', side_effect=lambda pid, snapshot_id: items[pid]):
+        all_tracks = {}
+        smart_playlists._add_playlist_tracks_to_library(all_tracks, ['bad', 'good'])
+
+    # The bad item only costs its own playlist
+    assert list(all_tracks) == ['t2']
+
+def test_add_playlist_tracks_to_library_uses_listed_playlists(mock_spotify):
+    mock_spotify.current_user_playlists.return_value = {
+        'items': [{'name': 'Mine', 'id': 'mine', 'snapshot_id': 'snap'}], 'total': 1
+    }
+    mock_spotify.playlist.return_value = {'name': 'Other', 'snapshot_id': 'snap2'}
+    with patch('smart_playlists.get_all_playlist_tracks', return_value=[]) as mock_get:
+        smart_playlists._add_playlist_tracks_to_library({}, ['mine', 'other'])
+
+    # Only the playlist missing from the user's listing is looked up
+    mock_spotify.playlist.assert_called_once_with('other', fields='name,snapshot_id')
+    assert mock_get.call_args_list == [call('mine', 'snap'), call('other', 'snap2')]
+
+def test_add_playlist_tracks_to_library_merges_concurrent_playlists(mock_spotify):
+    mock_spotify.playlist.return_value = {'name': 'P'}
+    items = {
+        'p1': [{'track': {'uri': 't1', 'name': 'N', 'artists': [{'name': 'A'}]}, 'added_at': '2026-01-28T13:00:00Z'}],
+        'p2': [{'track': {'uri': 't1', 'name': 'N', 'artists': [{'name': 'A'}]}, 'added_at': '2026-01-20T13:00:00Z'}],
+    }
+    with patch('smart_playlists.get_all_playlist_tracks', side_effect=lambda pid, snapshot_id: items[pid]):
+        all_tracks = {}
+        smart_playlists._add_playlist_tracks_to_library(all_tracks, ['p1', 'p2', 'broken'])
+
+    # The oldest date wins and a failing playlist doesn't stop the others
+    assert all_tracks['t1'].added_at == datetime(2026, 1, 20, 13, 0, 0)
@@ -0,0 +1,125 @@
+import pytest
+import spotipy
+import threading
+import spotify_client
+from unittest.mock import MagicMock, patch
+
+def test_get_client_is_shared():
+    assert spotify_client.get_client() is spotify_client.get_client()
+
+def test_get_client_uses_shared_token_cache():
+    sp = spotify_client.get_client()
+    assert sp.auth_manager.cache_handler.cache_path == spotify_client.TOKEN_CACHE_PATH
+    assert sp.auth_manager.scope == spotify_client.SCOPE
+
+def test_get_client_retry_policy():
+    sp = spotify_client.get_client()
+    adapter = sp._session.get_adapter('https://api.spotify.com')
+    # spotipy's retry policy is kept for server errors, but rate limits are
+    # left to retry_on_spotify_rate_limit so it sees Retry-After
+    assert adapter.max_retries.status == sp.status_retries
+    assert 500 in adapter.max_retries.status_forcelist
+    assert 429 not in adapter.max_retries.status_forcelist
+
+def test_parse_playlist_ids():
+    assert spotify_client.parse_playlist_ids('p1, p2 ,,p3,') == ('p1', 'p2', 'p3')
+    assert spotify_client.parse_playlist_ids('') == ()
+
+def test_rate_limiter_spaces_requests():
+    limiter = spotify_client.RateLimiter(rate=10)
+    with patch('spotify_client.time.monotonic', return_value=100.0), \
+         patch('spotify_client.time.sleep') as mock_sleep:
+        limiter.wait()
+        limiter.wait()
+        limiter.wait()
+
+    waits = [call.args[0] for call in mock_sleep.call_args_list]
+    assert waits == pytest.approx([0.1, 0.2])
+
+def test_rate_limiter_allows_burst_after_idle():
+    limiter = spotify_client.RateLimiter(rate=10, burst=3)
+    with patch('spotify_client.time.monotonic', return_value=100.0), \
+         patch('spotify_client.time.sleep') as mock_sleep:
+        for _ in range(5):
+            limiter.wait()
+
+    # The first three go out at once, then requests are spaced at the rate
+    waits = [call.args[0] for call in mock_sleep.call_args_list]
+    assert waits == pytest.approx([0.1, 0.2])
+
+def test_retry_on_spotify_rate_limit_gives_up():
+    mock_func = MagicMock(side_effect=spotipy.SpotifyException(429, -1, 'rate limit'))
+
+    @spotify_client.retry_on_spotify_rate_limit(max_retries=2, initial_delay=1)
+    def test_func():
+        return mock_func()
+
+    with patch('spotify_client.time.sleep') as mock_sleep:
+        with pytest.raises(spotipy.SpotifyException):
+            test_func()
+
+    assert mock_func.call_count == 3
+    assert [c.args[0] for c in mock_sleep.call_args_list] == [1, 2]
+
+def test_retry_on_spotify_rate_limit_other_errors():
+    mock_func = MagicMock(side_effect=spotipy.SpotifyException(404, -1, 'not found'))
+
+    @spotify_client.retry_on_spotify_rate_limit()
+    def test_func():
+        return mock_func()
+
+    with pytest.raises(spotipy.SpotifyException):
+        test_func()
+    assert mock_func.call_count == 1
+
+def test_retry_on_spotify_rate_limit_honors_retry_after():
+    rate_limit_error = spotipy.SpotifyException(429, -1, 'rate limit', headers={'Retry-After': '7'})
+    mock_func = MagicMock(side_effect=[rate_limit_error, 'ok'])
+
+    with patch('spotify_client.rate_limiter'), \
+         patch('spotify_client.time.sleep') as mock_sleep:
+        assert spotify_client.spotify_call(mock_func, 'arg') == 'ok'
+
+    mock_sleep.assert_called_once_with(7)
+    assert mock_func.call_count == 2
+
+def test_iter_pages_caps_requests_in_flight():
+    in_flight = 0
+    peak = 0
+    lock = threading.Lock()
+
+    def fetch_page(offset):
+        nonlocal in_flight, peak
+        with lock:
+            in_flight += 1
+            peak = max(peak, in_flight)
+        threading.Event().wait(0.01)
+        with lock:
+            in_flight -= 1
+        return {'items': [offset], 'total': 1000}
+
+    with patch('spotify_client.rate_limiter'), \
+         patch('spotify_client.request_slots', threading.BoundedSemaphore(2)), \
+         patch('spotify_client.MAX_PAGE_WORKERS', 4):
+        pages = list(spotify_client.iter_pages(fetch_page, 100))
+
+    assert [page['items'][0] for page in pages] == list(range(0, 1000, 100))
+    assert peak == 2
+
+def test_iter_pages_frees_request_slot_during_retry_wait():
+    rate_limit_error = spotipy.SpotifyException(429, -1, 'rate limit', headers={'Retry-After': '3'})
+    fetch_page = MagicMock(side_effect=[rate_limit_error, {'items': [0], 'total': 1}])
+    slots = threading.BoundedSemaphore(1)
+
+    def sleep(seconds):
+        # Other workers can still send requests while this one waits
+        assert slots.acquire(blocking=False)
+        slots.release()
+
+    with patch('spotify_client.rate_limiter'), \
+         patch('spotify_client.request_slots', slots), \
+         patch('spotify_client.time.sleep', side_effect=sleep) as mock_sleep:
+        pages = list(spotify_client.iter_pages(fetch_page, 100))
+
+    assert pages == [{'items': [0], 'total': 1}]
+    mock_sleep.assert_called_once_with(3)
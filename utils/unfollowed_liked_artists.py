@@ -1,6 +1,4 @@
 import argparse
-import spotipy
-from spotipy.oauth2 import SpotifyOAuth
 from collections import defaultdict
 from datetime import datetime
 from os import getenv, makedirs
@@ -8,11 +6,10 @@ from os.path import join
 from dotenv import load_dotenv
 import logging
 
+from spotify_client import get_client, spotify_call
+
 load_dotenv()
 
-CLIENT_ID = getenv('CLIENT_ID')
-CLIENT_SECRET = getenv('CLIENT_SECRET')
-REDIRECT_URI = getenv('REDIRECT_URI')
 MIN_LIKED_SONGS = int(getenv('MIN_LIKED_SONGS', '10'))
 
 
@@ -33,23 +30,18 @@ def setup_logging():
 
 
 def get_spotify_client():
-    return spotipy.Spotify(auth_manager=SpotifyOAuth(
-        client_id=CLIENT_ID,
-        client_secret=CLIENT_SECRET,
-        redirect_uri=REDIRECT_URI,
-        scope='user-follow-read user-library-read',
-    ))
+    return get_client('user-follow-read user-library-read')
 
 
 def get_followed_artist_ids(sp):
     followed = set()
-    results = sp.current_user_followed_artists(limit=50)
+    results = spotify_call(sp.current_user_followed_artists, limit=50)
 
     for artist in results['artists']['items']:
         followed.add(artist['id'])
 
     while results['artists']['next']:
-        results = sp.next(results['artists'])
+        results = spotify_call(sp.next, results['artists'])
         for artist in results['artists']['items']:
             followed.add(artist['id'])
 
@@ -64,7 +56,7 @@ def count_liked_songs_by_artist(sp):
     limit = 50
 
     while True:
-        results = sp.current_user_saved_tracks(limit=limit, offset=offset)
+        results = spotify_call(sp.current_user_saved_tracks, limit=limit, offset=offset)
         if not results['items']:
             break
 
@@ -3,6 +3,7 @@ from datetime import datetime
 from os import getenv
 from dotenv import load_dotenv
 
+from spotify_client import SOURCE_PLAYLIST_IDS
 from smart_playlists import (
     get_all_spotify_library_tracks,
     match_spotify_with_lastfm,
@@ -23,7 +24,7 @@ def generate_unplayed_playlist(spotify_library, unplayed_playlist_name):
     matched_tracks = match_spotify_with_lastfm(spotify_library)
 
     # Filter tracks with 0 plays
-    unplayed_tracks = [t for t in matched_tracks if t['playcount'] == 0]
+    unplayed_tracks = [t for t in matched_tracks if t.playcount == 0]
 
     logger.info(f"\nFound {len(unplayed_tracks)} tracks with 0 playcount in cache. Verifying with API...")
 
@@ -31,16 +32,20 @@ def generate_unplayed_playlist(spotify_library, unplayed_playlist_name):
     for i, t in enumerate(unplayed_tracks, 1):
         if i % 10 == 0:
             logger.info(f"Verified {i}/{len(unplayed_tracks)} tracks...")
-        pc = get_lastfm_track_playcount(t['artist'], t['name'])
+        pc = get_lastfm_track_playcount(t.artist, t.name)
         if pc == 0:
             verified_unplayed.append(t)
+        elif pc is None:
+            # The lookup failed, so fall back to the bulk playcount
+            logger.warning(f"  -> Could not verify {t.artist} - {t.name}, keeping it")
+            verified_unplayed.append(t)
         else:
-            logger.info(f"  -> False positive: {t['artist']} - {t['name']} has {pc} plays")
+            logger.info(f"  -> False positive: {t.artist} - {t.name} has {pc} plays")
 
     logger.info(f"\nFinal count: {len(verified_unplayed)} tracks with verified 0 playcount.")
 
     # A Spotify playlist can hold a lot of tracks, we'll add them all
-    unplayed_track_uris = [t['uri'] for t in verified_unplayed]
+    unplayed_track_uris = [t.uri for t in verified_unplayed]
 
     create_or_update_playlist(unplayed_playlist_name, unplayed_track_uris)
 
@@ -48,10 +53,6 @@ def main():
     script_start = time.time()
     logger.info(f"Unplayed tracks script started at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
 
-    # Ensure SOURCE_PLAYLIST_IDS is properly parsed
-    env_source_ids = getenv('SOURCE_PLAYLIST_IDS', '')
-    SOURCE_PLAYLIST_IDS = [pid.strip() for pid in env_source_ids.split(',')] if env_source_ids else []
-
     UNPLAYED_PLAYLIST_NAME = getenv('UNPLAYED_PLAYLIST_NAME', 'Unplayed Tracks')
 
     # 1. Fetch library once